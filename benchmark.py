@@ -0,0 +1,199 @@
+""" Benchmark Module """
+
+# Times seeding, game construction and scoring on synthetic data generated
+# from a fixed seed, so results from different commits can be compared:
+#
+#   python benchmark.py --sizes 1000 10000 100000 --db memory
+#
+# Each result is printed and appended to --output as one JSON line.
+
+from contextlib import redirect_stdout
+from random import Random
+import argparse
+import io
+import json
+import subprocess
+import tempfile
+import time
+
+from flask import Flask
+from model import *
+from classes import *
+
+
+################################################################################
+ ### Synthetic Data ###
+
+def make_question_files(file_dir, size, rng):
+    """ Writes 'size' question files in the TITLE/TEXT/ANSWER/SUBJECTS format
+        to 'file_dir'. Categories are even and difficulties skew easy, so
+        every QuestionSet's rules can be met.
+
+    """
+
+    with open('data/subjects.txt') as f:
+        subjects = [subj.strip() for subj in f if subj.strip()]
+
+    for i in range(size):
+        lines = ["TITLE: Synthetic question {}".format(i),
+                 "DIFFICULTY: {}".format(rng.choice((1, 1, 2, 2, 3))),
+                 "DURATIONS: {}".format(rng.choice((60, 120, 180))),
+                 "CATEGORY: {}".format(rng.choice('BTC')),
+                 "SUBJECTS: " + ", ".join(rng.sample(subjects, 2)),
+                 "",
+                 "TEXT: Explain synthetic concept {}.".format(i),
+                 "It spans a second line.",
+                 "ANSWER: Synthetic answer {}.".format(i),
+                 "With a second line too."]
+        with open('{}/q{:07d}.txt'.format(file_dir, i), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    return None
+
+
+def make_users_scores(size, rng):
+    """ Inserts size // 100 users (at least 10) and 'size' score events
+        spread over them and the seeded questions. Returns list of u_ids.
+
+    """
+
+    u_ids = ['user{}'.format(i) for i in range(max(10, size // 100))]
+    User.bulk_create(col='u_id', rows=({'u_id': u_id} for u_id in u_ids))
+
+    q_ids = [q_id for (q_id,) in db.session.query(Question.q_id)]
+    events = ({'u_id': rng.choice(u_ids), 'q_id': rng.choice(q_ids),
+               'points': rng.randint(0, 5),
+               'created_at': datetime.datetime(2018, 1, 1) +
+                             datetime.timedelta(minutes=i)}
+              for i in range(size))
+    for batch in iter_batches(events, SEED_BATCH_SIZE):
+        db.session.execute(ScoreEvent.__table__.insert(), batch)
+        ScoreStat.record(batch)
+        db.session.commit()
+
+    return u_ids
+
+
+################################################################################
+ ### Timing ###
+
+def time_op(func, runs):
+    """ Calls 'func' 'runs' times with its prints silenced. Returns dict of
+        best and mean wall time in milliseconds.
+
+    """
+
+    times = []
+    for i in range(runs):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    return {'runs': runs,
+            'best_ms': round(min(times) * 1000, 3),
+            'mean_ms': round(sum(times) / runs * 1000, 3)}
+
+
+def run_size(size, runs, rng):
+    """ Builds a fresh DB of 'size' questions and score events and times each
+        operation on it. Returns list of (op, timing dict).
+
+    """
+
+    db.drop_all()
+    db.create_all()
+    create_search_index()
+    question_bank.invalidate()
+
+    results = []
+    with tempfile.TemporaryDirectory() as file_dir:
+        make_question_files(file_dir, size, rng)
+        with redirect_stdout(io.StringIO()):
+            seed_subjects()
+        results.append(('seed_questions_qsubjs',
+                        time_op(lambda: seed_questions_qsubjs(
+                                        file_dir=file_dir), 1)))
+        results.append(('seed_questions_qsubjs (unchanged)',
+                        time_op(lambda: seed_questions_qsubjs(
+                                        file_dir=file_dir), 1)))
+
+    u_ids = make_users_scores(size, rng)
+
+    def cold_game():
+        question_bank.invalidate()
+        Game(g_id=0)
+
+    results.append(('Game (cold bank)', time_op(cold_game, runs)))
+    results.append(('Game', time_op(lambda: Game(g_id=0), runs)))
+    results.append(('Game (review)',
+                    time_op(lambda: Game(g_id=0, u_id=u_ids[0], review=True),
+                            runs)))
+
+    q_set = QuestionSet(category='C')
+    results.append(('QuestionSet._get_all_questions',
+                    time_op(q_set._get_all_questions, runs)))
+
+    terms = iter(['synthetic concept {}'.format(rng.randrange(size))
+                  for i in range(runs)])
+    results.append(('Question.search',
+                    time_op(lambda: Question.search(next(terms)), runs)))
+
+    q_ids = [q_id for (q_id,) in db.session.query(Question.q_id).limit(runs)]
+    points = iter(zip(q_ids * runs, range(runs)))
+
+    def add_points():
+        q_id, i = next(points)
+        Score.add_points(u_id=u_ids[0], q_id=q_id, new_points=i % 6)
+
+    results.append(('Score.add_points', time_op(add_points, runs)))
+    results.append(('LeaderStat.get_leaders',
+                    time_op(lambda: LeaderStat.get_leaders(category='C'),
+                            runs)))
+
+    return results
+
+
+def get_commit():
+    """ Returns the current git commit hash, or None outside a git repo. """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+################################################################################
+### Run Benchmarks ###
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark seeding, game "
+                                                 "construction and scoring")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help="questions and score events per run, eg: 1000 "
+                             "10000 100000 1000000")
+    parser.add_argument('--runs', type=int, default=20,
+                        help="repeats of each timed operation")
+    parser.add_argument('--seed', type=int, default=20180401)
+    parser.add_argument('--db', default='memory',
+                        help="'postgres', 'sqlite', 'memory' or a database URI;"
+                             " its tables are dropped")
+    parser.add_argument('--output', default='bench_output.txt')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    connect_to_db(app, db_uri=args.db)
+
+    commit = get_commit()
+    with open(args.output, 'a') as output:
+        for size in args.sizes:
+            rng = Random(args.seed)
+            for op, timing in run_size(size, args.runs, rng):
+                result = dict(commit=commit, db=db.engine.dialect.name,
+                              seed=args.seed, size=size, op=op, **timing)
+                line = json.dumps(result, sort_keys=True)
+                print(line)
+                output.write(line + '\n')
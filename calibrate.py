@@ -0,0 +1,207 @@
+""" Difficulty Calibration """
+
+# Suggests each question's difficulty from score history, and optionally
+# writes it back:
+#
+#   python calibrate.py --db postgres            # report suggestions
+#   python calibrate.py --db postgres --apply    # and update questions
+#
+# All score events are loaded into NumPy arrays once; per-question stats are
+# bincount sums, with no Python loop over events. Points are self-assessed, so
+# each answer is measured against the user's own mean on their other answers:
+# a question is hard if people score lower on it than they usually do.
+# Discrimination is the correlation between an answer's points and that same
+# rest-of-history mean, the item-rest correlation of classical test theory.
+
+from flask import Flask
+import argparse
+import time
+
+import numpy as np
+
+from model import *
+
+
+CALIBRATE_MIN_COUNT = 20  # answers needed before a question is re-rated
+CALIBRATE_EASY = 0.5  # relative points at or above this suggest difficulty 1
+CALIBRATE_HARD = -0.5  # relative points at or below this suggest difficulty 3
+CALIBRATE_CHUNK = 100000  # score events fetched and converted at a time
+
+
+################################################################################
+ ### Loading ###
+
+def load_score_arrays():
+    """ Reads every ScoreEvent in one query, CALIBRATE_CHUNK rows at a time,
+        into a structured array. Returns (u_codes, q_ids, points) arrays,
+        with users numbered 0 to n-1 in u_id order.
+
+    """
+
+    width = db.session.query(db.func.max(db.func.length(User.u_id))).scalar()
+    dtype = np.dtype([('u_id', 'U{}'.format(width or 1)),
+                      ('q_id', np.int64),
+                      ('points', np.int64)])
+
+    # The raw DBAPI cursor skips building a result row object per event, and
+    # NumPy converts each chunk of tuples in C
+    chunks = [np.zeros(0, dtype=dtype)]
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT u_id, q_id, points FROM score_events")
+        rows = cursor.fetchmany(CALIBRATE_CHUNK)
+        while rows:
+            chunks.append(np.array(rows, dtype=dtype))
+            rows = cursor.fetchmany(CALIBRATE_CHUNK)
+        cursor.close()
+    finally:
+        conn.close()
+
+    events = np.concatenate(chunks)
+    u_ids, u_codes = np.unique(events['u_id'], return_inverse=True)
+
+    return u_codes, events['q_id'], events['points']
+
+
+################################################################################
+ ### Statistics ###
+
+def calibrate_arrays(u_codes, q_ids, points, min_count=CALIBRATE_MIN_COUNT):
+    """ Computes per-question stats from parallel arrays of score events.
+        Returns dict of arrays over the questions with at least 'min_count'
+        usable answers: 'q_id', 'count', 'mean' points, 'relative' mean
+        points against each user's rest-of-history mean, 'discrimination'
+        (NaN where undefined) and 'suggested' difficulty 1 to 3.
+
+    """
+
+    points = points.astype(np.float64)
+
+    # Each user's mean over their other answers; users with one answer have
+    # no baseline and are left out
+    user_count = np.bincount(u_codes)
+    user_total = np.bincount(u_codes, weights=points)
+    rest_count = user_count[u_codes] - 1
+    usable = rest_count > 0
+    rest_mean = np.zeros_like(points)
+    rest_mean[usable] = ((user_total[u_codes] - points)[usable] /
+                         rest_count[usable])
+
+    q_found, q_codes = np.unique(q_ids[usable], return_inverse=True)
+    x = points[usable]
+    y = rest_mean[usable]
+
+    def sums(weights=None):
+        return np.bincount(q_codes, weights=weights, minlength=len(q_found))
+
+    n = sums()
+    sum_x, sum_y = sums(x), sums(y)
+    sum_xx, sum_yy, sum_xy = sums(x * x), sums(y * y), sums(x * y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sum_x / n
+        relative = (sum_x - sum_y) / n
+        discrimination = ((n * sum_xy - sum_x * sum_y) /
+                          np.sqrt((n * sum_xx - sum_x ** 2) *
+                                  (n * sum_yy - sum_y ** 2)))
+
+    suggested = np.full(len(q_found), 2, dtype=np.int64)
+    suggested[relative >= CALIBRATE_EASY] = 1
+    suggested[relative <= CALIBRATE_HARD] = 3
+
+    keep = n >= min_count
+    return {'q_id': q_found[keep],
+            'count': n[keep].astype(np.int64),
+            'mean': mean[keep],
+            'relative': relative[keep],
+            'discrimination': discrimination[keep],
+            'suggested': suggested[keep]}
+
+
+################################################################################
+ ### Write Back ###
+
+@track('apply_difficulties')
+def apply_difficulties(stats):
+    """ Sets each calibrated question's difficulty to its suggestion with one
+        executemany UPDATE of the changed rows, commits and invalidates the
+        question bank. Returns count of questions changed.
+
+    """
+
+    current = dict(db.session.query(Question.q_id, Question.difficulty))
+    changes = [{'b_q_id': q_id, 'b_difficulty': difficulty}
+               for q_id, difficulty in zip(stats['q_id'].tolist(),
+                                           stats['suggested'].tolist())
+               if current.get(q_id, difficulty) != difficulty]
+
+    if changes:
+        table = Question.__table__
+        db.session.execute(table.update()
+                                .where(table.c.q_id == db.bindparam('b_q_id'))
+                                .values(difficulty=db.bindparam(
+                                                   'b_difficulty')),
+                           changes)
+        db.session.commit()
+        question_bank.invalidate()
+
+    return len(changes)
+
+
+def report(stats, limit=10):
+    """ Prints how many questions were calibrated, the suggested mix, and the
+        least discriminating questions, which may be unclear or mis-keyed.
+
+    """
+
+    print("\n-- Calibrated {} questions: {} easy, {} medium, {} hard. --"
+          .format(len(stats['q_id']),
+                  *np.bincount(stats['suggested'], minlength=4)[1:]))
+
+    discrimination = stats['discrimination']
+    order = np.argsort(np.where(np.isnan(discrimination), np.inf,
+                                discrimination))
+    print("\n{:>8} {:>7} {:>6} {:>9} {:>8} {:>10}".format(
+          "q_id", "answers", "mean", "relative", "discrim", "suggested"))
+    for i in order[:limit]:
+        print("{:>8} {:>7} {:>6.2f} {:>+9.2f} {:>8.2f} {:>10}".format(
+              stats['q_id'][i], stats['count'][i], stats['mean'][i],
+              stats['relative'][i], stats['discrimination'][i],
+              stats['suggested'][i]))
+
+    return None
+
+
+################################################################################
+### Run Calibration ###
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Suggest question "
+                                                 "difficulties from scores")
+    parser.add_argument('--db', default=None,
+                        help="'postgres', 'sqlite', 'memory' or a database URI"
+                             " (default: $CLIJ_DATABASE_URI or 'postgres')")
+    parser.add_argument('--min-count', type=int, default=CALIBRATE_MIN_COUNT,
+                        help="answers needed before a question is re-rated")
+    parser.add_argument('--apply', action='store_true',
+                        help="update the questions' difficulties")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    connect_to_db(app, db_uri=args.db)
+
+    start = time.perf_counter()
+    arrays = load_score_arrays()
+    loaded = time.perf_counter()
+    stats = calibrate_arrays(*arrays, min_count=args.min_count)
+    done = time.perf_counter()
+
+    print("Loaded {} score events in {:.2f} s; computed stats in {:.2f} s."
+          .format(len(arrays[0]), loaded - start, done - loaded))
+    report(stats)
+
+    if args.apply:
+        print("\n-- Changed the difficulty of {} questions. --\n"
+              .format(apply_difficulties(stats)))
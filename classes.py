@@ -1,8 +1,11 @@
 """ Non-DB Python Classes """
 
-from random import sample
+from concurrent.futures import ThreadPoolExecutor
+from heapq import nlargest
+from math import comb
+from random import random, randrange, sample, shuffle
 from model import *
-from clij import analyze_input
+from clij import analyze_input, PROMPT
 
 class Game(object):
     """ Game class. """
@@ -10,20 +13,48 @@ class Game(object):
     # methods:
     #   play
 
-    def __init__(self, g_id):
+    @track('Game.__init__')
+    def __init__(self, g_id, u_id=None, review=False, session=None,
+                 subjects=None, bank=None):
         """ Initializes a game.
 
         @param g_id:      The game id, an integer 0 to 9, as set by run_session
+        @param u_id:      The user playing; needed for review mode
+        @param review:    If True, ask the user's most overdue questions
+                          rather than random ones
+        @param session:   The clij Session to play with; needed to play
+        @param subjects:  Optional subject titles; if given, only questions
+                          on any of them are asked, and categories without
+                          enough such questions are left out
+        @param bank:      The bank to pick from; question_bank if None, or
+                          a SnapshotBank to play without the DB
         @param *_q_set:   A set of Questions with category B, T, or C
 
         """
 
         self._g_id = g_id
+        self._session = session
+
+        # One query for the user's review priorities, shared by all sets
+        priorities = ScoreStat.get_priorities(u_id) if review and u_id else None
 
         # Get question sets from database
-        self._question_sets = [QuestionSet(category='B'),
-                               QuestionSet(category='T'),
-                               QuestionSet(category='C')]
+        self._question_sets = []
+        errors = []
+        for category in ('B', 'T', 'C'):
+            try:
+                self._question_sets.append(QuestionSet(category=category,
+                                                       priorities=priorities,
+                                                       session=session,
+                                                       subjects=subjects,
+                                                       bank=bank))
+            except QuestionRulesError as e:
+                if not subjects:
+                    raise
+                errors.append(str(e))
+
+        if not self._question_sets:
+            raise QuestionRulesError(" ".join(errors))
 
 
     def __repr__(self):
@@ -33,20 +64,114 @@ class Game(object):
     def _play(self):
         """  """
 
-        print("\nLet's get started!")
+        session = self._session
+        session.say("\nLet's get started!")
 
         for q_set in self._question_sets:
 
-            if not game_session['QUIT']:
+            if not session.quit:
                 q_set._ask()
 
+        session.scores.flush()
+
+        return None
+
+
+class GamePrefetcher(object):
+    """ Builds a session's next Game on a worker thread while the current one
+        is played, so continuing doesn't wait on the DB.
+
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next = None
+
+    def __repr__(self):
+        return '<GamePrefetcher next={}>'.format(self._next)
+
+
+    def start(self, g_id):
+        """ Starts building Game 'g_id' for the session in the background. """
+
+        self.discard()
+        if self._session.bank is None and isinstance(db.engine.pool,
+                                                     StaticPool):
+            return None  # one shared connection; 'take' builds it instead
+
+        session = self._session
+        self._next = self._executor.submit(self._build,
+                                           g_id=g_id,
+                                           u_id=session.user,
+                                           review=session.review,
+                                           session=session,
+                                           subjects=session.subjects,
+                                           bank=session.bank)
+        return None
+
+
+    def take(self, g_id):
+        """ Returns Game 'g_id', waiting for the background build if it is
+            still running, or building it now if none was started. Raises the
+            build's QuestionRulesError.
+
+        """
+
+        future, self._next = self._next, None
+        if future is None:
+            session = self._session
+            return Game(g_id=g_id,
+                        u_id=session.user,
+                        review=session.review,
+                        session=session,
+                        subjects=session.subjects,
+                        bank=session.bank)
+
+        return future.result()
+
+
+    def discard(self):
+        """ Drops any prefetched Game. One still building finishes on the
+            worker and is thrown away.
+
+        """
+
+        if self._next is not None:
+            self._next.cancel()
+            self._next = None
+
         return None
 
 
+    def close(self):
+        """ Discards any prefetched Game and stops the worker. """
+
+        self.discard()
+        self._executor.shutdown(wait=False)
+
+        return None
+
+
+    @staticmethod
+    def _build(**kwargs):
+        """ Builds a Game on the worker, then returns the worker's DB session
+            to the pool; the Game keeps only ids and difficulties.
+
+        """
+
+        try:
+            return Game(**kwargs)
+        finally:
+            if kwargs['bank'] is None:
+                db.session.remove()
+
+
 class QuestionSet(object):
     """ Question set. """
 
-    def __init__(self, category):
+    def __init__(self, category, priorities=None, session=None,
+                 subjects=None, bank=None):
         """ Initializes a question set.
 
             @param q_rules:    A tuple of the total number of difficulty points
@@ -57,7 +182,16 @@ class QuestionSet(object):
                                                    at least 1 easy question,
                                                    at least 1 medium question,
                                                    no minimum of hard questions.
-            @param questions:  The set of questions to be asked.
+            @param priorities: Optional dict of q_id: review priority from
+                               ScoreStat.get_priorities; if given, the most
+                               overdue questions are picked at each level.
+            @param session:    The clij Session to ask; needed to ask
+            @param subjects:   Optional subject titles; if given, questions
+                               are picked only from those on any of them.
+            @param bank:       The bank to pick from; question_bank if None.
+            @param q_pairs:    The set of (q_id, difficulty) pairs of the
+                               questions to be asked; their text and answers
+                               are fetched in one query when the set is asked.
 
         """
 
@@ -66,10 +200,14 @@ class QuestionSet(object):
         elif category == 'T':
             self._name = "Theoretical"
         elif category == 'C':
-            self._name == "Coding"
+            self._name = "Coding"
         self._category = category
+        self._priorities = priorities
+        self._session = session
+        self._subjects = subjects
+        self._bank = bank or question_bank
         self._q_rules = self._get_question_rules()
-        self._questions = self._get_all_questions()
+        self._q_pairs = self._get_all_questions()
 
 
     def __repr__(self):
@@ -77,54 +215,46 @@ class QuestionSet(object):
 
 
     def _get_all_questions(self):
-        """ Get set of questions for a particular category. Each category has
-            difficulty and quantity rules.
+        """ Get set of (q_id, difficulty) pairs for a particular category. Each
+            category has difficulty and quantity rules; the set meets the
+            minimums and its difficulties add up to exactly the total.
 
         """
 
+        pools = [self._bank.get(self._category, level,
+                                subjects=self._subjects)
+                 for level in range(1, 4)]
+
+        try:
+            counts = choose_difficulty_counts(self._q_rules,
+                                              [len(pool) for pool in pools])
+        except QuestionRulesError as e:
+            name = self._name
+            if self._subjects:
+                name += " ({})".format(", ".join(self._subjects))
+            raise QuestionRulesError("{} questions: {}".format(name, e))
+
         q_set = set([])
-        q_pool = set([])
-        remain = self._q_rules[0]
-
-        # Where i is a difficulty level 1 to 3
-        for i in range(1,4):
-            quantity = self._q_rules[i]
-            d_using, d_pool = self._get_questions_by_difficulty(i, quantity)
-            q_set.update(d_using)
-            q_pool.update(d_pool)
-            remain -= i * len(d_using)
-
-        # Fill q_set from q_pool until no difficulty points remain
-        while remain > 0 and q_pool:
-            q_obj = sample(q_pool, 1)[0]
-            q_set.add(q_obj)
-            q_pool.remove(q_obj)
-            remain -= q_obj.difficulty
+        for pool, count in zip(pools, counts):
+            if self._priorities is None:
+                q_set.update(sample(pool, count))
+            else:
+                q_set.update(self._get_most_due(pool, count))
 
         return q_set
 
 
-    def _get_questions_by_difficulty(self, level, quantity):
-        """  """
-
-        q_pool = set(Question.query
-                             .filter(Question.category == self._category,
-                                     Question.difficulty == level)
-                             .all())
+    def _get_most_due(self, pool, count):
+        """ Returns the 'count' pairs in 'pool' with the highest review
+            priority; unscored questions count as just due and ties are broken
+            at random.
 
-        # Put minimum number of each type of question into q_using;
-        # remove selected questions from q_pool
-        # Skip if no question of category and difficulty exists;
-        # modify the count if not enough questions exist
-        if quantity > 0 and q_pool:
-            if len(q_pool) < quantity:
-                quantity = len(q_pool)
-            q_using = sample(q_pool, quantity)
-            q_pool.difference_update(q_using)
-        else:
-            q_using = []
+        """
 
-        return (q_using, q_pool)
+        priorities = self._priorities
+        return nlargest(count, pool,
+                        key=lambda pair: (priorities.get(pair[0], 1.0),
+                                          random()))
 
 
     def _get_question_rules(self):
@@ -140,32 +270,117 @@ class QuestionSet(object):
         return q_rules
 
 
+    def _hydrate(self):
+        """ Returns the set's full Questions, easiest first, fetched in one
+            query. Only called once the user is ready to be asked.
+
+        """
+
+        q_ids = [q_id for q_id, difficulty in self._q_pairs]
+        questions = self._bank.hydrate(q_ids)
+        shuffle(questions)
+
+        return sorted(questions, key=lambda question: question.difficulty > 1)
+
+
+    @track('QuestionSet._ask')
     def _ask(self):
-        """  """
+        """ Asks each question in the set, starting with an easy one, and
+            records the points the user gives their answer. Points are
+            buffered and written together when the set ends.
 
-        ready = input("Are you ready for the {} questions?"
-                      .format(self._name) +
-                      PROMPT.format("'y' to continue, 's' to skip,"))
-        analyze_input(ready, other)
-
-        if not game_session['QUIT']:
-            for question in self._questions:
-                if question.difficulty == 1:
-                    first = question
-                    self._questions.remove(first)
-                    break
-
-        while not game_session['QUIT'] and self._questions:
-            if first:
-                curr_q = first
-                del first
-            else:
-                curr_q = self._questions.pop()
-            curr_q._ask()
-            points = input("Evaluate your answer and enter your score." +
-                           PROMPT.format("your points 1 to 5"))
-            if
-            Score.add_points()
+        """
+
+        session = self._session
+        ready = session.ask("Are you ready for the {} questions?"
+                            .format(self._name) +
+                            PROMPT.format("'y' to continue, 's' to skip,"))
+        analyze_input(session, ready, 'other')
 
+        if session.quit or ready.lower() == 's':
+            return None
+
+        for question in self._hydrate():
+            if session.quit:
+                break
+
+            session.say('\n' + question.title + '\n\n' + question.text)
+            done = session.ask("\nTake your time." +
+                               PROMPT.format("anything when you're done"))
+            analyze_input(session, done, 'other')
+            if session.quit:
+                break
+
+            session.say('\n' + (question.answer or "No answer on file."))
+            points = session.ask("\nEvaluate your answer and enter your " +
+                                 "score." + PROMPT.format("your points 1 to 5"))
+            while analyze_input(session, points, 'pts') is False:
+                points = session.ask("Oops!" +
+                                     PROMPT.format("your points 1 to 5"))
+
+            if not session.quit:
+                session.scores.add(u_id=session.user,
+                                   q_id=question.q_id,
+                                   new_points=int(points))
+
+        session.scores.flush()
+
+        return None
 
 
+class QuestionRulesError(Exception):
+    """ Raised when the question bank cannot satisfy a set's rules. """
+    pass
+
+
+def choose_difficulty_counts(q_rules, pool_sizes):
+    """ Returns (easy, medium, hard) question counts that meet the minimums in
+        'q_rules' and whose difficulty points add up to exactly its total,
+        given 'pool_sizes' questions available at each level. Each choice is
+        weighted by the number of question sets it allows, so sampling each
+        level uniformly afterwards gives a uniformly random set. Work is
+        bounded by the total, not the pool sizes. Raises QuestionRulesError.
+
+    """
+
+    total = q_rules[0]
+    mins = q_rules[1:]
+
+    for level, (minimum, size) in enumerate(zip(mins, pool_sizes), 1):
+        if minimum > size:
+            raise QuestionRulesError("need at least {} of difficulty {}, "
+                                     .format(minimum, level) +
+                                     "but the bank has {}.".format(size))
+
+    min_points = sum(level * minimum for level, minimum in enumerate(mins, 1))
+    if min_points > total:
+        raise QuestionRulesError("the minimums use {} difficulty points, "
+                                 .format(min_points) +
+                                 "more than the total of {}.".format(total))
+
+    options = []
+    weights = []
+    easy_max = min(pool_sizes[0], total)
+    for easy in range(mins[0], easy_max + 1):
+        med_max = min(pool_sizes[1], (total - easy) // 2)
+        for med in range(mins[1], med_max + 1):
+            hard, extra = divmod(total - easy - 2 * med, 3)
+            if extra or not mins[2] <= hard <= pool_sizes[2]:
+                continue
+            options.append((easy, med, hard))
+            weights.append(comb(pool_sizes[0], easy) *
+                           comb(pool_sizes[1], med) *
+                           comb(pool_sizes[2], hard))
+
+    if not options:
+        raise QuestionRulesError("no mix of the {} easy, {} medium and {} hard "
+                                 .format(*pool_sizes) +
+                                 "questions adds up to {} points."
+                                 .format(total))
+
+    # Integer weights keep the pick exact even for very large pools
+    pick = randrange(sum(weights))
+    for option, weight in zip(options, weights):
+        if pick < weight:
+            return option
+        pick -= weight
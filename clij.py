@@ -1,9 +1,30 @@
 """ App Manager """
 
-from flask import Flask
+import time
+START = time.perf_counter()
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import re
-from model import *
-from classes import *
+
+# Flask, SQLAlchemy and the game modules load in the background; see
+# 'load_backend'
+model = None
+classes = None
+snapshot = None
+IMPORT_TIMES = {}  # step: seconds, filled by 'load_backend'
+OPTIONS = {'DB': None,  # process-wide command line options
+           'SNAPSHOT': None,
+           'IMPORTTIME': False,
+           'INSTRUMENT': False,
+           'INSTRUMENT_JSON': None}
+
+# Regular Expression comparisons for user input
+UID_RE = re.compile(r'^\w{1,8}$')
+PTS_RE = re.compile(r'^[1-5]$')
+
+# Standard prompt hint for user input
+PROMPT = "\n(enter {} or 'q' to quit) "  # 'your User ID', 'the points', etc
 
 # Functions:
 # [ ]start
@@ -24,40 +45,259 @@ from classes import *
 #       [x]play again?
 #   [x]exit (q at any time)
 
-def run_session():
-    """ Game manager. """
+class Session(object):
+    """ One player's game state and I/O. The console session uses input() and
+        print(); the server gives each connection its own.
+
+    """
+
+    def __init__(self, ask=input, say=print, review=False, subjects=None,
+                 bank=None):
+        """ Initializes a session.
+
+            @param ask:       Function of a prompt that returns the user's reply
+            @param say:       Function that shows the user a message
+            @param review:    If True, games ask overdue questions first
+            @param subjects:  Optional subject titles games are limited to
+            @param bank:      SnapshotBank to play from without the DB, or
+                              None; set once loaded
+            @param scores:    The ScoreBuffer for the user's points; set once
+                              the backend is loaded
+
+        """
+
+        # Session runs only while 'quit' is False and 'gnum' <= 10
+        self.quit = False
+        self.user = None
+        self.gnum = -1
+        self.review = review
+        self.subjects = subjects
+        self.bank = bank
+        self.ask = ask
+        self.say = say
+        self.scores = None
+
+
+    def __repr__(self):
+        return '<Session user={} gnum={}>'.format(self.user, self.gnum)
+
+
+    def end(self):
+        """ Ends the session and writes any buffered scores. """
+
+        self.quit = True
+        if self.scores:
+            self.scores.flush()
+
+        return None
+
+
+def run_session(session):
+    """ Game manager for the console. """
 
     # Clear Console
 
-    greet_user()
+    greet_user(session)
+    report_time("greeting shown")
+
+    # Import and connect to the DB, or open the snapshot, while the user
+    # types their name
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if OPTIONS['SNAPSHOT']:
+            backend = executor.submit(load_snapshot, OPTIONS['SNAPSHOT'])
+        else:
+            backend = executor.submit(load_backend, OPTIONS['DB'],
+                                      OPTIONS['INSTRUMENT'])
+        session.user = get_username(session)
+        session.bank = backend.result()
+    report_time("backend ready")
+
+    if session.bank is None:
+        session.scores = model.score_buffer
+    else:
+        session.scores = snapshot.NullScoreBuffer(say=session.say)
+    play_games(session)
+    dismiss_user(session)
+    report_queries()
+
+    return None
+
+
+def play_games(session):
+    """ Plays games until the user quits or has played 10. Shared by the
+        console and the server.
+
+    """
+
+    if session.subjects and not session.quit:
+        known = (session.bank or model.question_bank).get_subjects()
+        unknown = [subject for subject in session.subjects
+                   if subject.lower() not in known]
+        if unknown:
+            session.say("\nSorry, no questions are on " +
+                        ", ".join(unknown) + ".")
+            session.end()
+
+    if not session.quit and session.bank is None:
+        model.User.create(session.user, say=session.say)
+
+    # The next game is built in the background while this one is played; in
+    # review mode, once this one's scores are in
+    prefetcher = classes.GamePrefetcher(session)
+    try:
+        while not session.quit:
+            session.gnum += 1
+            session.say("\n\n-- Instantiate Game " + str(session.gnum) + " --")
+            try:
+                game = prefetcher.take(g_id=session.gnum)  # gets question sets
+            except classes.QuestionRulesError as e:
+                session.say("\nSorry, I can't put a game together. " + str(e))
+                session.end()
+                break
+            if session.gnum < 10 and not session.review:
+                prefetcher.start(g_id=session.gnum + 1)
+            game._play()
+            if session.quit:
+                break
+            if session.gnum < 10 and session.review:
+                prefetcher.start(g_id=session.gnum + 1)
+            is_play_again(session)
+    finally:
+        prefetcher.close()
+
+    return None
+
+
+def load_backend(db_uri=None, instrument=False):
+    """ Imports Flask, the ORM models and game classes, then connects to the
+        DB. These imports dominate startup, so 'run_session' calls this on a
+        worker thread after the greeting is shown. Times each step. The
+        server calls it once at startup.
+
+    """
+
+    global model, classes
+
+    start = time.perf_counter()
+    from flask import Flask
+    IMPORT_TIMES['flask'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import model
+    IMPORT_TIMES['model'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import classes
+    IMPORT_TIMES['classes'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app = Flask(__name__)
+    model.connect_to_db(app, db_uri=db_uri, instrument=instrument)
+    model.db.session.remove()  # return the connection to the pool
+    IMPORT_TIMES['connect'] = time.perf_counter() - start
+
+    return None
+
+
+def search_questions(terms, limit=None, category=None):
+    """ Prints the questions best matching 'terms', with their ranks. """
 
-    game_session['USER'] = get_username()
-    if not game_session['QUIT']:
-        User.create(game_session['USER'])
+    matches = model.Question.search(terms,
+                                    limit=limit or model.SEARCH_LIMIT,
+                                    category=category)
+    if not matches:
+        print("No questions match '{}'.".format(terms))
 
-    while not game_session['QUIT']:
-        game_session['GNUM'] += 1
-        print("\n\n-- Instantiate Game " + str(game_session['GNUM']) + " --")
-        game = Game(g_id=game_session['GNUM'])  # instantiation gets question set
-        print("-- Start Game with 'game.play' --")
-        # game.play()
-        if game_session['QUIT']:
-            break
-        is_play_again()
+    for question, rank in matches:
+        print("{:8.3f}  #{:<6} {} {}  {}".format(rank, question.q_id,
+                                                 question.category,
+                                                 question.difficulty,
+                                                 question.title[:60]))
 
-    dismiss_user()
+    return None
+
+
+def show_leaderboards(category=None, subjects=None, by='mean', limit=None):
+    """ Prints the top users overall, or in a category, or on each subject,
+        ranked by mean or best points.
+
+    """
+
+    boards = []
+    if subjects:
+        s_ids = dict(model.db.session.query(model.db.func.lower(
+                                                model.Subject.title),
+                                            model.Subject.s_id))
+        for subject in subjects:
+            if subject.lower() not in s_ids:
+                print("\nNo subject '{}'.".format(subject))
+                continue
+            boards.append((subject, {'s_id': s_ids[subject.lower()]}))
+    elif category:
+        boards.append(("Category " + category, {'category': category}))
+    else:
+        boards.append(("Everyone", {}))
+
+    for name, board in boards:
+        leaders = model.LeaderStat.get_leaders(
+                      by=by, limit=limit or model.LEADERBOARD_SIZE, **board)
+        print("\n-- Leaderboard: {}, by {} points --".format(name, by))
+        if not leaders:
+            print("No scores yet.")
+        for rank, leader in enumerate(leaders, 1):
+            print("{:>3}. {:<8}  mean {:.2f}  best {}  answers {}".format(
+                  rank, leader.u_id, leader.mean, leader.best, leader.count))
 
     return None
 
 
-def analyze_input(input_string, input_type):
+def load_snapshot(path):
+    """ Imports the game classes and memory-maps the question bank snapshot
+        at 'path' for play without the DB. Returns the SnapshotBank.
+
+    """
+
+    global model, classes, snapshot
+
+    start = time.perf_counter()
+    import model
+    import classes
+    import snapshot
+    IMPORT_TIMES['classes'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bank = snapshot.SnapshotBank(path)
+    IMPORT_TIMES['snapshot'] = time.perf_counter() - start
+
+    return bank
+
+
+def report_time(event):
+    """ With --importtime, prints time since startup and, once the backend is
+        loaded, how long each of its imports took.
+
+    """
+
+    if not OPTIONS['IMPORTTIME']:
+        return None
+
+    print("[importtime] {} after {:.1f} ms".format(
+          event, (time.perf_counter() - START) * 1000))
+    for step, secs in IMPORT_TIMES.items():
+        print("[importtime]   {:<8} {:8.1f} ms".format(step, secs * 1000))
+    IMPORT_TIMES.clear()
+
+    return None
+
+
+def analyze_input(session, input_string, input_type):
     """ Checks if user wants to quit; then if input matches its requirements.
         Returns None or True/False.
 
     """
 
     if input_string.lower() == 'q':
-        game_session['QUIT'] = True
+        session.end()
         return None
 
     if input_type == 'uid':
@@ -72,83 +312,165 @@ def analyze_input(input_string, input_type):
     return None
 
 
-def greet_user():
+def report_queries():
+    """ Prints per-operation query counts and times if instrumentation is on,
+        and writes them as JSON with --instrument-json.
+
+    """
+
+    if not model or not model.query_stats.enabled:
+        return None
+
+    print('\n' + model.query_stats.format_summary())
+    if OPTIONS['INSTRUMENT_JSON']:
+        model.query_stats.export(OPTIONS['INSTRUMENT_JSON'])
+
+    return None
+
+
+def greet_user(session):
     """ Greets user. """
 
     G_MSG = ("Hi! I'm Alexa Trebeca, host of Command Line Interview Jeopardy." +
              "\nI'm so glad you're here. =D")
-    print('\n\n' + G_MSG)
+    session.say('\n\n' + G_MSG)
     return None
 
 
-def dismiss_user():
+def dismiss_user(session):
     """ Says goodbye to user. """
 
+    if session.scores:
+        session.scores.flush()
+
     Q_MSG = "Thank you! Goodbye! =D"
-    print('\n' + Q_MSG + '\n\n')
+    session.say('\n' + Q_MSG + '\n\n')
     return None
 
 
-def get_username():
-    """ Gets username from STDIN; returns it for storage. """
+def get_username(session):
+    """ Gets username from the session's input; returns it for storage. """
 
     i = 0
     while i <= 3:
         if i == 0:
             usermsg = "\nWhat may I call you? "
-            UID = input(usermsg + PROMPT.format('your User ID'))
+            UID = session.ask(usermsg + PROMPT.format('your User ID'))
         elif 0 < i < 3:
             usermsg = "\nOops! Please enter up to 8 ASCII alphanumeric characters."
-            UID = input(usermsg + PROMPT.format('your User ID'))
+            UID = session.ask(usermsg + PROMPT.format('your User ID'))
         else:
-            print("\nI'm sorry you're having trouble. Try again soon.")
+            session.say("\nI'm sorry you're having trouble. Try again soon.")
             UID = 'q'
 
-        success = analyze_input(UID, 'uid')
+        success = analyze_input(session, UID, 'uid')
         if success is False:
             i += 1
         else:
             return UID
 
 
-def is_play_again():
+def is_play_again(session):
     """ Asks user if they want to continue. Force quits if game count is 10. """
 
-    # Future versions could analyze game's questions' scores for 'good job!' msg
+    if session.bank is None:
+        session.say(get_feedback(session.user))
 
-    if game_session['GNUM'] == 10:
-        game_session['QUIT'] = True
-        print("\nWow {}! That was so good! ".format(game_session['USER']) +
-              "I've got to run, but let's play again soon, okay?")
+    if session.gnum == 10:
+        session.end()
+        session.say("\nWow {}! That was so good! ".format(session.user) +
+                    "I've got to run, but let's play again soon, okay?")
     else:
         usermsg = ("\nThat was fun! =D Could we play again, {}? "
-                   .format(game_session['USER']))
-        other = input(usermsg + PROMPT.format("'y' to continue"))
-        analyze_input(other, 'other')
+                   .format(session.user))
+        other = session.ask(usermsg + PROMPT.format("'y' to continue"))
+        analyze_input(session, other, 'other')
 
     return None
 
 
-################################################################################
-### Run App ###
+def get_feedback(u_id):
+    """ Returns a 'good job!' message from the user's running score stats. """
 
-if __name__ == '__main__':
+    stat = model.ScoreStat.get(u_id=u_id)
+    if not stat or not stat.count:
+        return "\nNo scores yet -- answer a few and I'll keep track!"
 
-    # Start Flask app and connect to DB
-    app = Flask(__name__)
-    connect_to_db(app)
+    msg = ("\nYou've scored {} answers, averaging {:.1f} points."
+           .format(stat.count, stat.mean))
+    if stat.rolling >= 4:
+        msg += " Good job! You're on a roll!"
+    elif stat.rolling > stat.mean:
+        msg += " You're getting better, keep it up!"
 
-    # Regular Expression comparisons for user input
-    UID_RE = re.compile(r'^\w{1,8}$')
-    PTS_RE = re.compile(r'^[1-5]$')
+    return msg
 
-    # Standard prompt hint for user input
-    PROMPT = "\n(enter {} or 'q' to quit) "  # 'your User ID', 'the points', etc
 
-    # Program runs only while 'QUIT' is False and 'GNUM' <= 10
-    game_session = {'QUIT': False,
-                    'USER': None,
-                    'GNUM': -1}
+################################################################################
+### Run App ###
 
-    # Start game session
-    run_session()
+if __name__ == '__main__':
+
+    # Command line options
+    parser = argparse.ArgumentParser(description="Command Line Interview "
+                                                 "Jeopardy")
+    parser.add_argument('--review', action='store_true',
+                        help="ask your most overdue questions first")
+    parser.add_argument('--db', default=None,
+                        help="'postgres', 'sqlite', 'memory' or a database URI"
+                             " (default: $CLIJ_DATABASE_URI or 'postgres')")
+    parser.add_argument('--subjects', nargs='+', metavar='SUBJECT',
+                        help="only ask questions on these subjects, eg: "
+                             "Graph Tree")
+    parser.add_argument('--snapshot', metavar='PATH',
+                        help="play from a question bank snapshot, without "
+                             "the DB; scores aren't saved")
+    parser.add_argument('--export-snapshot', metavar='PATH',
+                        help="write the question bank to a snapshot at PATH "
+                             "and exit")
+    parser.add_argument('--search', metavar='TERMS',
+                        help="list the questions best matching TERMS and exit")
+    parser.add_argument('--leaderboard', action='store_true',
+                        help="list the top users overall, or in --category "
+                             "or --subjects, and exit")
+    parser.add_argument('--by', choices=('mean', 'best'), default='mean',
+                        help="rank --leaderboard users by mean or best points")
+    parser.add_argument('--limit', type=int, default=None,
+                        help="matches listed by --search or users by "
+                             "--leaderboard (default: 10)")
+    parser.add_argument('--category', choices=('B', 'T', 'C'),
+                        help="only search or rank questions of this category")
+    parser.add_argument('--importtime', action='store_true',
+                        help="report startup and import times")
+    parser.add_argument('--instrument', action='store_true',
+                        help="count SQL statements per operation and print "
+                             "a summary on exit")
+    parser.add_argument('--instrument-json', metavar='PATH',
+                        help="also write the query summary to PATH as JSON")
+    args = parser.parse_args()
+    if args.snapshot and args.review:
+        parser.error("--review needs score history, which snapshots lack")
+
+    OPTIONS.update({'DB': args.db,
+                    'SNAPSHOT': args.snapshot,
+                    'IMPORTTIME': args.importtime,
+                    'INSTRUMENT': args.instrument or bool(args.instrument_json),
+                    'INSTRUMENT_JSON': args.instrument_json})
+
+    # Search or export the question bank, or start game session
+    if args.search is not None:
+        load_backend(OPTIONS['DB'], OPTIONS['INSTRUMENT'])
+        search_questions(args.search, args.limit, args.category)
+        report_queries()
+    elif args.leaderboard:
+        load_backend(OPTIONS['DB'], OPTIONS['INSTRUMENT'])
+        show_leaderboards(args.category, args.subjects, args.by, args.limit)
+        report_queries()
+    elif args.export_snapshot:
+        load_backend(OPTIONS['DB'], OPTIONS['INSTRUMENT'])
+        import snapshot
+        count = snapshot.export_snapshot(args.export_snapshot)
+        print("\n-- Wrote {} questions to {}. --\n"
+              .format(count, args.export_snapshot))
+    else:
+        run_session(Session(review=args.review, subjects=args.subjects))
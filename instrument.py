@@ -0,0 +1,208 @@
+""" Query Instrumentation """
+
+# Opt-in counts of SQL statements, rows and time per logical operation, built
+# on SQLAlchemy engine events. Rows are those changed by DML and those fetched
+# from SELECTs. Operations are marked with the 'track' decorator; statements
+# count toward every tracked operation running on the same thread, so totals
+# are inclusive. Enable with CLIJ_INSTRUMENT=1, the CLI's --instrument flag or
+# 'query_stats.enable(engine)'.
+
+from contextlib import contextmanager
+from sqlalchemy import event
+import functools
+import json
+import threading
+import time
+
+
+class QueryStats(object):
+    """ Per-operation totals of calls, statements, rows and wall/SQL time. """
+
+    def __init__(self):
+        self.enabled = False
+        self._ops = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<QueryStats enabled={} ops={}>'.format(self.enabled,
+                                                       len(self._ops))
+
+
+    def enable(self, engine):
+        """ Starts counting statements run on 'engine'. """
+
+        if not event.contains(engine, 'before_cursor_execute',
+                              self._before_execute):
+            event.listen(engine, 'before_cursor_execute', self._before_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_execute)
+        self.enabled = True
+
+        return None
+
+
+    def reset(self):
+        """ Clears all totals. """
+
+        with self._lock:
+            self._ops = {}
+
+        return None
+
+
+    @contextmanager
+    def operation(self, name):
+        """ Context manager that attributes statements run inside it on this
+            thread to operation 'name'.
+
+        """
+
+        stack = self._get_stack()
+        totals = {'statements': 0, 'rows': 0, 'sql_seconds': 0.0}
+        stack.append(totals)
+        start = time.perf_counter()
+        try:
+            yield totals
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                op = self._ops.setdefault(name, {'calls': 0, 'statements': 0,
+                                                 'rows': 0, 'seconds': 0.0,
+                                                 'sql_seconds': 0.0})
+                op['calls'] += 1
+                op['seconds'] += seconds
+                for key, val in totals.items():
+                    op[key] += val
+
+
+    def track(self, name):
+        """ Decorator that runs the function as operation 'name' when
+            instrumentation is enabled, and untouched otherwise.
+
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.operation(name):
+                    return func(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+
+    def summary(self):
+        """ Returns dict of operation name: totals, with per-call averages. """
+
+        with self._lock:
+            ops = {name: dict(op) for name, op in self._ops.items()}
+
+        for op in ops.values():
+            op['statements_per_call'] = op['statements'] / op['calls']
+            op['ms_per_call'] = op['seconds'] / op['calls'] * 1000
+
+        return ops
+
+
+    def format_summary(self):
+        """ Returns the summary as a text table, most statements first. """
+
+        rows = sorted(self.summary().items(),
+                      key=lambda item: item[1]['statements'], reverse=True)
+        lines = ["{:<32} {:>6} {:>6} {:>10} {:>8} {:>10}".format(
+                 "operation", "calls", "stmts", "stmts/call", "rows",
+                 "ms/call")]
+        for name, op in rows:
+            lines.append("{:<32} {:>6} {:>6} {:>10.1f} {:>8} {:>10.2f}".format(
+                         name[:32], op['calls'], op['statements'],
+                         op['statements_per_call'], op['rows'],
+                         op['ms_per_call']))
+
+        return '\n'.join(lines)
+
+
+    def export(self, path):
+        """ Writes the summary to 'path' as JSON. """
+
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+        return None
+
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        self._local.start = time.perf_counter()
+
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        seconds = time.perf_counter() - getattr(self._local, 'start',
+                                                time.perf_counter())
+        stack = self._get_stack()
+        rows = 0
+        if cursor.description is None:
+            rows = max(cursor.rowcount, 0)  # rows changed by DML
+        elif stack:
+            # Rows returned are counted as they are fetched; drivers such as
+            # sqlite3 report no rowcount for SELECTs
+            context.cursor = CountingCursor(cursor, list(stack))
+        for totals in stack:
+            totals['statements'] += 1
+            totals['rows'] += rows
+            totals['sql_seconds'] += seconds
+
+
+class CountingCursor(object):
+    """ DBAPI cursor proxy that adds the rows fetched through it to the
+        totals of the operations that ran its statement. Rows fetched after
+        an operation ends aren't counted.
+
+    """
+
+    def __init__(self, cursor, stack):
+        self._cursor = cursor
+        self._stack = stack
+
+    def __repr__(self):
+        return '<CountingCursor {!r}>'.format(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._count(len(rows))
+        return rows
+
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+
+    def _count(self, rows):
+        for totals in self._stack:
+            totals['rows'] += rows
+
+
+query_stats = QueryStats()
+track = query_stats.track
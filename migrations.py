@@ -0,0 +1,162 @@
+""" Schema Migrations """
+
+# Versioned, in-place upgrades of existing databases. Each migration is a
+# step in MIGRATIONS; 'upgrade' runs the steps newer than the DB's version in
+# order and records each in the schema_version table. connect_to_db calls it,
+# so a DB is brought up to date the first time new code connects to it:
+#
+#   python migrations.py --db postgres            # upgrade
+#   python migrations.py --db postgres --status   # show version
+#
+# Steps check the schema before changing it, so a step interrupted before
+# its version was recorded can simply run again. A new DB is created in the
+# latest shape by db.create_all() and stamped with the latest version.
+
+from flask import Flask
+import argparse
+import datetime
+
+from model import *
+
+
+MIGRATION_LOCK_KEY = 7373  # PostgreSQL advisory lock held while upgrading
+
+
+################################################################################
+ ### Migrations ###
+
+def add_hot_path_indexes():
+    """ Indexes the columns games, scoring and subject lookups filter on. """
+
+    with db.engine.begin() as conn:
+        for index in (Question.__table__.indexes | Score.__table__.indexes |
+                      Q_Subj.__table__.indexes):
+            conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                         index.name, index.table.name,
+                         ", ".join(column.name for column in index.columns)))
+
+    return None
+
+
+def convert_durations():
+    """ Makes 'questions.durations' an integer array on PostgreSQL. SQLite
+        keeps text, rewritten from '120,60,' to IntList's '120,60'.
+
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        column = [column for column
+                  in db.inspect(db.engine).get_columns('questions')
+                  if column['name'] == 'durations'][0]
+        if isinstance(column['type'], postgresql.ARRAY):
+            return None
+        db.engine.execute("ALTER TABLE questions ALTER COLUMN durations "
+                          "TYPE integer[] USING string_to_array(rtrim("
+                          "replace(durations, ' ', ''), ','), ',')::integer[]")
+    else:
+        db.engine.execute("UPDATE questions SET durations = rtrim(replace("
+                          "durations, ' ', ''), ',') WHERE durations LIKE "
+                          "'%,' OR durations LIKE '% %'")
+
+    return None
+
+
+# (version, name, step); append new steps, never reorder or renumber
+MIGRATIONS = [
+    (1, "Move Score.points histories into score_events", migrate_score_points),
+    (2, "Key qs_subjs by (q_id, s_id)", migrate_qs_subjs_key),
+    (3, "Index questions, scores and qs_subjs hot paths", add_hot_path_indexes),
+    (4, "Store question durations as integers", convert_durations),
+    (5, "Add the full-text search index", create_search_index),
+    (6, "Fill the leaderboard from score history", rebuild_leaderboard),
+]
+
+
+################################################################################
+ ### Running Migrations ###
+
+def get_version():
+    """ Returns the DB's schema version: 0 for a DB from before versioning,
+        or None if it has no tables yet.
+
+    """
+
+    tables = db.inspect(db.engine).get_table_names()
+    if SchemaVersion.__tablename__ in tables:
+        return (db.session.query(db.func.max(SchemaVersion.version))
+                          .scalar() or 0)
+
+    return 0 if Question.__tablename__ in tables else None
+
+
+def upgrade():
+    """ Creates missing tables and runs every migration newer than the DB's
+        version, recording each. Stamps a new DB with the latest version
+        instead. Returns count of migrations run.
+
+    """
+
+    lock = None
+    if db.engine.dialect.name == 'postgresql':
+        # One process migrates; the others wait, then find nothing to do
+        lock = db.engine.connect()
+        lock.execute("SELECT pg_advisory_lock({})".format(MIGRATION_LOCK_KEY))
+
+    try:
+        version = get_version()
+        db.create_all()  # does nothing to already created tables
+
+        if version is None:
+            stamp(MIGRATIONS[-1][0], "Create schema")
+            create_search_index()
+            return 0
+
+        pending = [migration for migration in MIGRATIONS
+                   if migration[0] > version]
+        for number, name, step in pending:
+            print("-- Migrating to schema version {}: {}. --".format(number,
+                                                                    name))
+            step()
+            stamp(number, name)
+    finally:
+        if lock is not None:
+            lock.execute("SELECT pg_advisory_unlock({})"
+                         .format(MIGRATION_LOCK_KEY))
+            lock.close()
+
+    return len(pending)
+
+
+def stamp(version, name):
+    """ Records that the DB is at schema 'version'. """
+
+    db.session.add(SchemaVersion(version=version, name=name,
+                                 applied_at=datetime.datetime.utcnow()))
+    db.session.commit()
+
+    return None
+
+
+################################################################################
+### Run Migrations ###
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Upgrade the database "
+                                                 "schema in place")
+    parser.add_argument('--db', default=None,
+                        help="'postgres', 'sqlite', 'memory' or a database URI"
+                             " (default: $CLIJ_DATABASE_URI or 'postgres')")
+    parser.add_argument('--status', action='store_true',
+                        help="show the schema version and pending migrations "
+                             "without upgrading")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    connect_to_db(app, db_uri=args.db, migrate=not args.status)
+
+    version = get_version()
+    print("Schema version {} of {}.".format(version, MIGRATIONS[-1][0]))
+    for number, name, step in MIGRATIONS:
+        if version is None or number > version:
+            print("  pending {}: {}".format(number, name))
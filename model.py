@@ -1,10 +1,138 @@
 """ ORM Models """
 
 from flask_sqlalchemy import SQLAlchemy
+from instrument import query_stats, track
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.pool import QueuePool, StaticPool
+import atexit
+import copy
+import datetime
+import functools
+import hashlib
+import multiprocessing
+import os
 import pathlib
 import re
+import sqlite3
+import threading
 
-db = SQLAlchemy()
+class TunedSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy that creates its engine with the ENGINE_OPTIONS for
+        its backend, overridden by app.config['CLIJ_ENGINE_OPTIONS'].
+
+    """
+
+    def apply_driver_hacks(self, app, info, options):
+        backend = info.drivername.split('+')[0]
+        options.update(copy.deepcopy(ENGINE_OPTIONS.get(backend, {})))
+        options.update(copy.deepcopy(app.config.get('CLIJ_ENGINE_OPTIONS',
+                                                    {})))
+        rv = super().apply_driver_hacks(app, info, options)
+
+        # In-memory SQLite shares one static connection; it has no pool
+        if options.get('poolclass') is StaticPool:
+            for key in POOL_OPTIONS:
+                options.pop(key, None)
+
+        return rv
+
+
+db = TunedSQLAlchemy()
+
+
+class IntList(db.TypeDecorator):
+    """ List of integers: an integer array on PostgreSQL, and comma-separated
+        text elsewhere. Also accepts the old '120,60,' strings.
+
+    """
+
+    impl = db.Text
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.ARRAY(db.Integer))
+        return dialect.type_descriptor(db.Text())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            value = parse_int_list(value)
+        value = [int(val) for val in value]
+        if dialect.name == 'postgresql':
+            return value
+        return ','.join(str(val) for val in value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, list):
+            return value
+        return parse_int_list(value)
+
+# Set constants
+DB_URIS = {'postgres': 'postgresql:///cliijeopardy',
+           'sqlite': 'sqlite:///' + str(pathlib.Path(__file__).resolve()
+                                        .parent / 'cliijeopardy.sqlite3'),
+           'memory': 'sqlite://'}
+ENGINE_OPTIONS = {
+    'postgresql': {'pool_size': 5,
+                   'max_overflow': 10,
+                   'pool_timeout': 30,  # seconds
+                   'pool_recycle': 1800,  # seconds; -1 never recycles
+                   'pool_pre_ping': True,
+                   'use_batch_mode': True},  # psycopg2 execute_batch
+    'sqlite': {'poolclass': QueuePool,
+               'pool_size': 5,
+               'max_overflow': 10,
+               'pool_timeout': 30,
+               'pool_recycle': -1,
+               'pool_pre_ping': False,
+               'connect_args': {'check_same_thread': False,
+                                'cached_statements': 256}}}
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+ENGINE_OPTION_CHECKS = {
+    'pool_size': lambda val: isinstance(val, int) and val >= 0,
+    'max_overflow': lambda val: isinstance(val, int) and val >= -1,
+    'pool_timeout': lambda val: isinstance(val, (int, float)) and val > 0,
+    'pool_recycle': lambda val: isinstance(val, int) and (val == -1 or
+                                                          val > 0),
+    'pool_pre_ping': lambda val: isinstance(val, bool),
+    'use_batch_mode': lambda val: isinstance(val, bool),
+    'poolclass': lambda val: isinstance(val, type),
+    'connect_args': lambda val: isinstance(val, dict)}
+QATTR_RE = re.compile(r'^[A-Z]{4,10}(?=:)')  # 4 to 10 A-Z chars, then ':'
+SEED_BATCH_SIZE = 1000  # rows per INSERT/commit when bulk seeding
+PARSE_CHUNKSIZE = 64  # files handed to each parser process at a time
+STAT_ALPHA = 0.3  # weight of newest score in ScoreStat rolling means
+REVIEW_BASE_DAYS = 1.0  # review interval after a 1-point answer; 5 => 16 days
+SEARCH_LIMIT = 10  # matches returned by Question.search
+LEADERBOARD_SIZE = 10  # users returned by LeaderStat.get_leaders
+SEARCH_TERM_RE = re.compile(r'\w+')
+SEARCH_VECTOR = (  # PostgreSQL; title matches rank highest, then text, answer
+    "setweight(to_tsvector('english', title), 'A') || "
+    "setweight(to_tsvector('english', text), 'B') || "
+    "setweight(to_tsvector('english', coalesce(answer, '')), 'C')")
+SEARCH_DDL = {
+    'postgresql': [
+        "CREATE INDEX IF NOT EXISTS ix_questions_search ON questions "
+        "USING gin ((" + SEARCH_VECTOR + "))"],
+    'sqlite': [  # FTS5 index over the questions table, kept in step by triggers
+        "CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5("
+        "title, text, answer, content='questions', content_rowid='q_id', "
+        "tokenize='porter unicode61')",
+        "CREATE TRIGGER IF NOT EXISTS questions_fts_ai AFTER INSERT ON "
+        "questions BEGIN INSERT INTO questions_fts(rowid, title, text, answer) "
+        "VALUES (new.q_id, new.title, new.text, new.answer); END",
+        "CREATE TRIGGER IF NOT EXISTS questions_fts_ad AFTER DELETE ON "
+        "questions BEGIN INSERT INTO questions_fts(questions_fts, rowid, "
+        "title, text, answer) VALUES ('delete', old.q_id, old.title, "
+        "old.text, old.answer); END",
+        "CREATE TRIGGER IF NOT EXISTS questions_fts_au AFTER UPDATE ON "
+        "questions BEGIN INSERT INTO questions_fts(questions_fts, rowid, "
+        "title, text, answer) VALUES ('delete', old.q_id, old.title, "
+        "old.text, old.answer); INSERT INTO questions_fts(rowid, title, text, "
+        "answer) VALUES (new.q_id, new.title, new.text, new.answer); END"]}
 
 ################################################################################
  ### Classes ###
@@ -28,9 +156,11 @@ class Base(db.Model):
 
 
     @classmethod
+    @track('Base.create')
     def create(cls, col, val, **kwargs):
         """ Inserts new record into the DB. Returns success/failure message and
-            new object or None.
+            new object or None. Uses one INSERT ... ON CONFLICT DO NOTHING, so
+            concurrent creates of the same 'col' value can't both succeed.
 
         """
 
@@ -38,20 +168,227 @@ class Base(db.Model):
         if not val:
             msg = "Cannot create {} with empty value. You submitted '{}'."
             record = None
-        elif len(cls.get_records(col, val)) == 0:
-            new_item = cls(**kwargs)
-            db.session.add(new_item)
-            db.session.commit()
-            msg = "New {} '{}' created!"
-            record = new_item
         else:
-            msg = ("Welcome back!" if class_name == 'User'
-                   else "{} '{}' already exists.")
-            record = None
+            record = cls._insert_ignore(col, cls(**kwargs))
+            if record:
+                msg = "New {} '{}' created!"
+            else:
+                msg = ("Welcome back!" if class_name == 'User'
+                       else "{} '{}' already exists.")
 
         return (msg.format(class_name, val), record)
 
 
+    @classmethod
+    def _insert_ignore(cls, col, record):
+        """ Inserts the new object 'record' in one round trip with INSERT ...
+            ON CONFLICT ('col') DO NOTHING, with RETURNING on PostgreSQL, and
+            commits. 'col' is a column name or a tuple of them. Only a
+            conflict on 'col' is ignored; other constraint failures raise.
+            Returns the record, now persistent, or None if its 'col' value
+            already exists.
+
+        """
+
+        table = cls.__table__
+        values = {column.key: getattr(record, column.key)
+                  for column in table.columns
+                  if getattr(record, column.key) is not None}
+        cols = (col,) if isinstance(col, str) else col
+
+        if db.engine.dialect.name == 'sqlite':
+            # SQLite has no RETURNING here; a new key comes from lastrowid
+            result = db.session.execute(cls._sqlite_insert_ignore(values,
+                                                                  cols),
+                                        values)
+            db.session.commit()
+            if not result.rowcount:
+                return None
+            for column in table.primary_key:
+                if getattr(record, column.key) is None:
+                    setattr(record, column.key, result.lastrowid)
+        else:
+            stmt = (postgresql.insert(table)
+                              .values(**values)
+                              .on_conflict_do_nothing(index_elements=[
+                                  table.c[name] for name in cols])
+                              .returning(*table.columns))
+            row = db.session.execute(stmt).first()
+            db.session.commit()
+            if row is None:
+                return None
+            for column in table.columns:
+                setattr(record, column.key, row[column])
+
+        # Attach the inserted row to the session without a second INSERT
+        make_transient_to_detached(record)
+        db.session.add(record)
+
+        return record
+
+
+    @classmethod
+    def _insert_ignore_rows(cls, rows):
+        """ Inserts list of row dicts, all with the same keys, in one
+            statement, skipping rows that conflict with existing keys. Other
+            constraint failures raise. Doesn't commit. Returns count inserted.
+
+        """
+
+        table = cls.__table__
+        if db.engine.dialect.name == 'sqlite':
+            # One prepared statement; pysqlite sums rowcount over the rows
+            result = db.session.execute(cls._sqlite_insert_ignore(rows[0]),
+                                        rows)
+        else:
+            result = db.session.execute(postgresql.insert(table)
+                                                  .values(rows)
+                                                  .on_conflict_do_nothing())
+
+        return result.rowcount
+
+
+    @classmethod
+    def _sqlite_insert_ignore(cls, row, cols=None):
+        """ Returns a SQLite INSERT of the columns in row dict 'row' that
+            skips rows conflicting on 'cols', or on any unique key if None,
+            with ON CONFLICT DO NOTHING. SQLite before 3.24 lacks it and gets
+            INSERT OR IGNORE, which also hides NOT NULL and CHECK failures.
+
+        """
+
+        if not supports_upsert():
+            return cls.__table__.insert().prefix_with('OR IGNORE')
+
+        target = "({}) ".format(", ".join(cols)) if cols else ""
+        return cls._insert_text(row, "ON CONFLICT {}DO NOTHING".format(target))
+
+
+    @classmethod
+    def _upsert_rows(cls, rows, updates):
+        """ Inserts list of row dicts, all with the same keys; where a row's
+            primary key already exists, applies 'updates' to the stored row
+            instead. 'updates' maps column names to SQL expressions of the
+            stored values, as '<table>.<column>', and the row's, as ':<key>'.
+            The DB does the arithmetic, so concurrent writers can't lose each
+            other's changes. Uses INSERT ... ON CONFLICT DO UPDATE, or an
+            UPDATE per row then an INSERT of the rows not found where the DB
+            lacks it. Rows are written in key order, so concurrent writers
+            lock them in the same order. Doesn't commit.
+
+        """
+
+        if not rows:
+            return None
+
+        table = cls.__table__
+        (key,) = [column.name for column in table.primary_key]
+        rows = sorted(rows, key=lambda row: row[key])
+        assignments = ", ".join("{} = {}".format(column, expr)
+                                for column, expr in updates.items())
+
+        if supports_upsert():
+            db.session.execute(cls._insert_text(rows[0],
+                                                "ON CONFLICT ({}) DO UPDATE "
+                                                "SET {}".format(key,
+                                                                assignments)),
+                               rows)
+            return None
+
+        stmt = cls._bind_types(db.text("UPDATE {} SET {} WHERE {} = :{}"
+                                       .format(table.name, assignments, key,
+                                               key)),
+                               rows[0])
+        missing = [row for row in rows
+                   if not db.session.execute(stmt, row).rowcount]
+        if missing:
+            db.session.execute(cls._insert_text(missing[0]), missing)
+
+        return None
+
+
+    @classmethod
+    def _insert_text(cls, row, suffix=''):
+        """ Returns a textual INSERT of the columns in row dict 'row', with
+            'suffix' SQL after it, eg an ON CONFLICT clause; SQLAlchemy 1.2
+            builds those for PostgreSQL only. Binds are typed by column.
+
+        """
+
+        table = cls.__table__
+        columns = [column for column in table.columns if column.key in row]
+        stmt = db.text("INSERT INTO {} ({}) VALUES ({}) {}".format(
+                       table.name,
+                       ", ".join(column.name for column in columns),
+                       ", ".join(":" + column.key for column in columns),
+                       suffix))
+
+        return cls._bind_types(stmt, row)
+
+
+    @classmethod
+    def _bind_types(cls, stmt, row):
+        """ Gives the binds of text 'stmt' named after columns in 'row' their
+            column's type, so values are converted as by the ORM.
+
+        """
+
+        return stmt.bindparams(*[db.bindparam(column.key, type_=column.type)
+                                 for column in cls.__table__.columns
+                                 if column.key in row and
+                                 column.key in stmt._bindparams])
+
+
+    @classmethod
+    @track('Base.bulk_create')
+    def bulk_create(cls, col, rows, existing=None, batch_size=None):
+        """ Inserts many new records into the DB with one existence lookup,
+            batched INSERTs and one commit per batch. 'rows' is an iterable of
+            dicts of column values; rows whose 'col' value is empty or already
+            exists are skipped. Returns (inserted, skipped) counts.
+
+            @param existing:    Optional set of 'col' values known to be in the
+                                DB; updated in place as rows are inserted. When
+                                None, the column is read once from the DB.
+            @param batch_size:  Rows per INSERT/commit; SEED_BATCH_SIZE if None.
+
+        """
+
+        column = cls.__table__.columns.get(col)
+        if existing is None:
+            existing = set(val for (val,) in db.session.query(column))
+        batch_size = batch_size or SEED_BATCH_SIZE
+
+        inserted = 0
+        skipped = 0
+        batch = []
+
+        for row in rows:
+            val = row.get(col)
+            if not val or val in existing:
+                skipped += 1
+                continue
+            existing.add(val)
+            batch.append(row)
+            if len(batch) >= batch_size:
+                inserted += cls._insert_batch(batch)
+                batch = []
+
+        if batch:
+            inserted += cls._insert_batch(batch)
+
+        return (inserted, skipped)
+
+
+    @classmethod
+    def _insert_batch(cls, batch):
+        """ Inserts list of row dicts in one executemany and commits. """
+
+        db.session.execute(cls.__table__.insert(), batch)
+        db.session.commit()
+        return len(batch)
+
+
 class Subject(Base):
     """ Subjects model; filled in the function 'seed_subjects'. """
 
@@ -105,13 +442,15 @@ class Q_Subj(Base):
     """
 
     __tablename__ = 'qs_subjs'
+    __table_args__ = (db.Index('ix_qs_subjs_s_id', 's_id'),)
 
-    qs_id = db.Column(db.Integer, primary_key=True)
-    q_id = db.Column(db.Integer, db.ForeignKey('questions.q_id'), nullable=False)
-    s_id = db.Column(db.Integer, db.ForeignKey('subjects.s_id'), nullable=False)
+    # Primary key (q_id, s_id) also serves lookups by q_id
+    q_id = db.Column(db.Integer, db.ForeignKey('questions.q_id'),
+                     primary_key=True)
+    s_id = db.Column(db.Integer, db.ForeignKey('subjects.s_id'),
+                     primary_key=True)
 
     def __init__(self, s_id, q_id):
-        self.qs_id = make_qs_id(q_id, s_id)
         self.q_id = q_id
         self.s_id = s_id
 
@@ -126,23 +465,44 @@ class Q_Subj(Base):
 
         """
 
-        qs_id = make_qs_id(q_id, s_id)
-        msg, record = super().create(col='qs_id', val=qs_id,
+        msg, record = super().create(col=('q_id', 's_id'), val=(q_id, s_id),
                                      q_id=q_id, s_id=s_id)
         print(msg)
         return None  # should never need to return this record
 
 
+    @classmethod
+    @track('Q_Subj.link')
+    def link(cls, rows):
+        """ Inserts dicts of q_id and s_id, skipping links that already
+            exist, in one statement per SEED_BATCH_SIZE rows. Commits. Returns
+            (inserted, skipped) counts.
+
+        """
+
+        inserted = 0
+        skipped = 0
+        for batch in iter_batches(rows, SEED_BATCH_SIZE):
+            added = cls._insert_ignore_rows(batch)
+            inserted += added
+            skipped += len(batch) - added
+        db.session.commit()
+
+        return (inserted, skipped)
+
+
 class Question(Base):
     """ Questions model """
 
     __tablename__ = 'questions'
+    __table_args__ = (db.Index('ix_questions_category_difficulty',
+                               'category', 'difficulty'),)
 
     q_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.Text, nullable=False, unique=True)
     text = db.Column(db.Text, nullable=False)
     difficulty = db.Column(db.Integer, nullable=False, default=2)  # 1, 2, 3
-    durations = db.Column(db.Text, nullable=False, default="180,")  # '120,60,'
+    durations = db.Column(IntList, nullable=False, default=[180])  # [120, 60]
     category = db.Column(db.String(1), nullable=False, default="T")  # B, T, C
     answer = db.Column(db.Text)
     subjects = db.relationship('Subject',
@@ -154,7 +514,7 @@ class Question(Base):
         self.title = title
         self.text = text
         self.difficulty = kwargs.get('difficulty', 2)
-        self.durations = kwargs.get('durations', "180,")
+        self.durations = kwargs.get('durations', [180])
         self.category = kwargs.get('category', "T")
         self.answer = kwargs.get('answer', None)
 
@@ -172,6 +532,8 @@ class Question(Base):
         msg, record = super().create(col='title', val=title,
                                      title=title, text=text, **kwargs)
         print(msg)
+        if record:
+            question_bank.invalidate()
         return record
 
 
@@ -185,30 +547,83 @@ class Question(Base):
             self.title = new_val
             db.session.add(self)
             db.session.commit()
+            question_bank.invalidate()
             print("Question title changed!")
             return None
 
 
+    @classmethod
+    @track('Question.search')
+    def search(cls, terms, limit=SEARCH_LIMIT, category=None):
+        """ Full-text search of question titles, text and answers through the
+            index made by 'create_search_index'. Every word in 'terms' must
+            match, allowing for word endings. Returns list of (Question, rank)
+            pairs, best match first.
+
+        """
+
+        words = SEARCH_TERM_RE.findall(terms or '')
+        if not words:
+            return []
+
+        params = {'limit': limit, 'category': category}
+        if db.engine.dialect.name == 'sqlite':
+            params['terms'] = ' '.join('"{}"'.format(word) for word in words)
+            stmt = ("SELECT q.q_id, -bm25(questions_fts, 10.0, 2.0, 1.0) "
+                    "AS rank FROM questions_fts "
+                    "JOIN questions q ON q.q_id = questions_fts.rowid "
+                    "WHERE questions_fts MATCH :terms")
+        else:
+            params['terms'] = ' '.join(words)
+            stmt = ("SELECT q_id, ts_rank(" + SEARCH_VECTOR + ", query) "
+                    "AS rank FROM questions, "
+                    "plainto_tsquery('english', :terms) query "
+                    "WHERE " + SEARCH_VECTOR + " @@ query")
+        if category:
+            stmt += " AND category = :category"
+        stmt += " ORDER BY rank DESC LIMIT :limit"
+
+        ranks = dict(db.session.execute(stmt, params).fetchall())
+        questions = question_bank.hydrate(ranks)
+
+        return sorted(((question, ranks[question.q_id])
+                       for question in questions),
+                      key=lambda pair: pair[1], reverse=True)
+
+
     def add_subjects(self, new_subjs=[]):
-        """ Initiates Q_Subj link for each subject in the list. """
-
-        for new_subj in new_subjs:
-
-            # Get Subject from DB
-            subj = Subject.get_records(col='title', val=new_subj)
-            if not subj:
-                y_or_n = input("Subject '{}' does not exist. "
-                               .format(new_subj) +
-                               "Do you want to add it? (y/n) ")
-                if y_or_n.lower() == 'y':
-                    subj = Subject.create(new_subj)
-                else:
-                    print("Cannot add current subject; trying the next.")
-                    continue
+        """ Links the question to each subject title in the list. Resolves
+            all titles in one query, offers once to create the missing ones
+            in bulk, then inserts the links in one statement.
+
+        """
+
+        titles = list(dict.fromkeys(subj for subj in new_subjs if subj))
+        if not titles:
+            return None
+
+        # Get Subjects from DB
+        s_ids = dict(db.session.query(Subject.title, Subject.s_id)
+                               .filter(Subject.title.in_(titles)))
+        missing = [title for title in titles if title not in s_ids]
+        if missing:
+            y_or_n = input("Subjects {} do not exist. "
+                           .format(", ".join(repr(title) for title in missing)) +
+                           "Do you want to add them? (y/n) ")
+            if y_or_n.lower() == 'y':
+                Subject.bulk_create(col='title',
+                                    rows=({'title': title} for title in missing),
+                                    existing=set(s_ids))
+                s_ids.update(db.session.query(Subject.title, Subject.s_id)
+                                       .filter(Subject.title.in_(missing)))
             else:
-                subj = subj[0]
+                print("Cannot add missing subjects; linking the rest.")
 
-            Q_Subj.create(self.q_id, subj.s_id)
+        inserted, skipped = Q_Subj.link({'q_id': self.q_id, 's_id': s_ids[title]}
+                                        for title in titles if title in s_ids)
+        print("{} subjects linked, {} already linked.".format(inserted, skipped))
+        if inserted:
+            question_bank.invalidate()
 
         return None
 
@@ -234,14 +649,14 @@ class User(Base):
 
 
     @classmethod
-    def create(cls, u_id):
-        """ Inserts new record into the DB. Prints success/failure message.
-            Returns new object or None.
+    def create(cls, u_id, say=print):
+        """ Inserts new record into the DB. Shows success/failure message with
+            'say', print by default. Returns new object or None.
 
         """
 
         msg, record = super().create(col='u_id', val=u_id, u_id=u_id)
-        print(msg)
+        say(msg)
         return record
 
 
@@ -272,9 +687,13 @@ class Score(Base):
         Eg: u_id 4291 + q_id 573 >> '4,3,4,5,5,4,'
         Eg: u_id 1942 + q_id 375 >> '3,4,5,4,5,'
 
+        New points are recorded as ScoreEvent rows instead; 'points' strings
+        are only read by 'migrate_score_points'.
+
     """
 
     __tablename__ = 'scores'
+    __table_args__ = (db.Index('ix_scores_u_id_q_id', 'u_id', 'q_id'),)
 
     score_id = db.Column(db.Text, primary_key=True)
     u_id = db.Column(db.Text, db.ForeignKey('users.u_id'), nullable=False)
@@ -306,25 +725,20 @@ class Score(Base):
 
 
     @classmethod
+    @track('Score.add_points')
     def add_points(cls, u_id=None, q_id=None, new_points=None):
-        """ Add new points value for user-question pair. Inserts new u-q pair
-            into DB if necessary.
+        """ Add new points value for user-question pair as a single ScoreEvent
+            INSERT, and update its ScoreStats.
 
         """
 
         if not u_id or not q_id or new_points not in range(6):
             return None
 
-        score_id = make_score_id(u_id, q_id)
-        score = cls.get_records(col='score_id', val=score_id)
-
-        if not score:
-            msg, score = cls.create(u_id=u_id, q_id=q_id)
-        else:
-            score = score[0]
-
-        score.points += (str(new_points) + ",")
-        db.session.add(score)
+        event = {'u_id': u_id, 'q_id': q_id, 'points': new_points,
+                 'created_at': datetime.datetime.utcnow()}
+        db.session.execute(ScoreEvent.__table__.insert(), [event])
+        ScoreStat.record([event])
         db.session.commit()
         print("Scores updated!")
 
@@ -337,12 +751,502 @@ class Score(Base):
         pass
 
 
+class ScoreEvent(Base):
+    """ Score events model. One row per answer: the points (0 to 5) a user
+        gave themselves on a question, and when. A pair's history is read
+        with 'get_history'; aggregates are kept in ScoreStat.
+
+    """
+
+    __tablename__ = 'score_events'
+    __table_args__ = (db.Index('ix_score_events_u_id_q_id', 'u_id', 'q_id'),)
+
+    event_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    u_id = db.Column(db.Text, db.ForeignKey('users.u_id'), nullable=False)
+    q_id = db.Column(db.Integer, db.ForeignKey('questions.q_id'), nullable=False)
+    points = db.Column(db.Integer, nullable=False)  # 0 to 5
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return '<ScoreEvent u_id={} q_id={} points={}>'.format(self.u_id,
+                                                               self.q_id,
+                                                               self.points)
+
+
+    @classmethod
+    def get_history(cls, u_id, q_id):
+        """ Returns list of points for user-question pair in chronological
+            order of least-to-most recent, like the old 'Score.points'.
+
+        """
+
+        rows = (db.session.query(cls.points)
+                          .filter(cls.u_id == u_id, cls.q_id == q_id)
+                          .order_by(cls.event_id))
+
+        return [points for (points,) in rows]
+
+
+class ScoreStat(Base):
+    """ Score aggregates model, kept up to date on every score write by
+        'record'. One row per user (q_id is None), per question (u_id is None)
+        and per user-question pair, so stats are primary key lookups.
+        'rolling' is an exponential moving mean weighted by STAT_ALPHA.
+
+    """
+
+    __tablename__ = 'score_stats'
+
+    stat_id = db.Column(db.Text, primary_key=True)
+    u_id = db.Column(db.Text, db.ForeignKey('users.u_id'), index=True)
+    q_id = db.Column(db.Integer, db.ForeignKey('questions.q_id'))
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    last = db.Column(db.Integer)
+    rolling = db.Column(db.Float)
+    updated_at = db.Column(db.DateTime)
+
+    def __init__(self, u_id=None, q_id=None):
+        self.stat_id = make_stat_id(u_id, q_id)
+        self.u_id = u_id
+        self.q_id = q_id
+        self.count = 0
+        self.total = 0
+
+    def __repr__(self):
+        return '<ScoreStat {} count={}>'.format(self.stat_id, self.count)
+
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+    @classmethod
+    def get(cls, u_id=None, q_id=None):
+        """ Returns stats for a user, a question or a pair, or None. """
+
+        return cls.query.get(make_stat_id(u_id, q_id))
+
+
+    @classmethod
+    def record(cls, events):
+        """ Folds score event dicts into the user, question and pair stats
+            with one upsert per affected row, then into the leaderboards with
+            LeaderStat.record. Each row's events are summed first, and the DB
+            adds them to what is stored, so concurrent writers don't lose
+            counts. Leaves the changes for the caller to commit with the
+            events.
+
+        """
+
+        rows = {}
+        for event in events:
+            points = event['points']
+            for u_id, q_id in [(event['u_id'], None), (None, event['q_id']),
+                               (event['u_id'], event['q_id'])]:
+                stat_id = make_stat_id(u_id, q_id)
+                if stat_id not in rows:
+                    # 'rolling' is the mean for a new row; a stored one is
+                    # decayed by 'decay' and then 'tail' is added
+                    rows[stat_id] = {'stat_id': stat_id, 'u_id': u_id,
+                                     'q_id': q_id, 'count': 0, 'total': 0,
+                                     'last': None, 'rolling': None,
+                                     'decay': 1.0, 'tail': 0.0}
+                row = rows[stat_id]
+                row['count'] += 1
+                row['total'] += points
+                row['last'] = points
+                row['rolling'] = (points if row['rolling'] is None
+                                  else row['rolling'] + STAT_ALPHA *
+                                  (points - row['rolling']))
+                row['decay'] *= 1 - STAT_ALPHA
+                row['tail'] += STAT_ALPHA * (points - row['tail'])
+                row['updated_at'] = (event.get('created_at') or
+                                     datetime.datetime.utcnow())
+
+        cls._upsert_rows(list(rows.values()), {
+            'count': "score_stats.count + :count",
+            'total': "score_stats.total + :total",
+            'last': ":last",
+            'rolling': "CASE WHEN score_stats.rolling IS NULL THEN :rolling "
+                       "ELSE score_stats.rolling * :decay + :tail END",
+            'updated_at': ":updated_at"})
+
+        LeaderStat.record(events)
+
+        return None
+
+
+    @classmethod
+    def get_priorities(cls, u_id, now=None):
+        """ Returns dict of q_id: review priority for every question the user
+            has scored, from one query on the indexed u_id column. Priority is
+            time since the last attempt over the review interval, which
+            doubles with each point of rolling mean; 1.0 means just due.
+            Unscored questions should be treated as 1.0.
+
+        """
+
+        now = now or datetime.datetime.utcnow()
+        rows = (db.session.query(cls.q_id, cls.rolling, cls.updated_at)
+                          .filter(cls.u_id == u_id, cls.q_id != None))
+
+        priorities = {}
+        for q_id, rolling, updated_at in rows:
+            interval = REVIEW_BASE_DAYS * 2 ** (rolling - 1)
+            elapsed = (now - updated_at).total_seconds() / 86400
+            priorities[q_id] = elapsed / interval
+
+        return priorities
+
+
+class LeaderStat(Base):
+    """ Leaderboard model, kept up to date on every score write by 'record'.
+        One row per user per board: 'all', each category and each subject
+        of the questions they have scored. 'mean' is stored, and the board
+        is indexed with it and with 'best' (and 'count' to break ties), so a
+        top-k query reads about k index entries however many scores there
+        are. 'rebuild_leaderboard' refills the table from ScoreEvents.
+
+    """
+
+    __tablename__ = 'leader_stats'
+    __table_args__ = (db.Index('ix_leader_stats_board_mean',
+                               'board', 'mean', 'count'),
+                      db.Index('ix_leader_stats_board_best',
+                               'board', 'best', 'count'))
+
+    leader_id = db.Column(db.Text, primary_key=True)
+    board = db.Column(db.Text, nullable=False)  # 'all', 'c:B', 's:12'
+    u_id = db.Column(db.Text, db.ForeignKey('users.u_id'), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    mean = db.Column(db.Float, nullable=False, default=0.0)
+    best = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime)
+
+    def __init__(self, board, u_id):
+        self.leader_id = make_leader_id(board, u_id)
+        self.board = board
+        self.u_id = u_id
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self.best = 0
+
+    def __repr__(self):
+        return '<LeaderStat {} mean={:.2f}>'.format(self.leader_id, self.mean)
+
+
+    @classmethod
+    def record(cls, events):
+        """ Folds score event dicts into the boards of each user, with one
+            SELECT for the questions' categories and subjects and one upsert
+            per affected row, so concurrent flushes add up as in
+            ScoreStat.record. Leaves the changes for the caller to commit
+            with the events.
+
+        """
+
+        q_ids = set(event['q_id'] for event in events)
+        boards = {}
+        rows = (db.session.query(Question.q_id, Question.category,
+                                 Q_Subj.s_id)
+                          .outerjoin(Q_Subj, Q_Subj.q_id == Question.q_id)
+                          .filter(Question.q_id.in_(list(q_ids))))
+        for q_id, category, s_id in rows:
+            q_boards = boards.setdefault(q_id, ['all',
+                                                make_board(category=category)])
+            if s_id is not None:
+                q_boards.append(make_board(s_id=s_id))
+
+        rows = {}
+        for event in events:
+            points = event['points']
+            for board in boards.get(event['q_id'], ['all']):
+                leader_id = make_leader_id(board, event['u_id'])
+                if leader_id not in rows:
+                    rows[leader_id] = {'leader_id': leader_id, 'board': board,
+                                       'u_id': event['u_id'], 'count': 0,
+                                       'total': 0, 'best': 0}
+                row = rows[leader_id]
+                row['count'] += 1
+                row['total'] += points
+                row['mean'] = row['total'] / row['count']
+                row['best'] = max(row['best'], points)
+                row['updated_at'] = (event.get('created_at') or
+                                     datetime.datetime.utcnow())
+
+        greatest = 'max' if db.engine.dialect.name == 'sqlite' else 'GREATEST'
+        cls._upsert_rows(list(rows.values()), {
+            'count': "leader_stats.count + :count",
+            'total': "leader_stats.total + :total",
+            'mean': "(leader_stats.total + :total) * 1.0 / "
+                    "(leader_stats.count + :count)",
+            'best': greatest + "(leader_stats.best, :best)",
+            'updated_at': ":updated_at"})
+
+        return None
+
+
+    @classmethod
+    @track('LeaderStat.get_leaders')
+    def get_leaders(cls, category=None, s_id=None, by='mean',
+                    limit=LEADERBOARD_SIZE, min_count=1):
+        """ Returns list of the top 'limit' LeaderStats overall, or for a
+            category or subject, ranked 'by' 'mean' or 'best' points; ties go
+            to the user with more answers. Users with fewer than 'min_count'
+            answers on the board are left out.
+
+        """
+
+        if by not in ('mean', 'best'):
+            raise ValueError("Rank leaders by 'mean' or 'best', not '{}'."
+                             .format(by))
+
+        rank = getattr(cls, by)
+        return (cls.query.filter(cls.board == make_board(category, s_id),
+                                 cls.count >= min_count)
+                         .order_by(rank.desc(), cls.count.desc())
+                         .limit(limit)
+                         .all())
+
+
+class SchemaVersion(Base):
+    """ Schema versions model. One row per migration applied by
+        'migrations.upgrade'; the highest version is the DB's.
+
+    """
+
+    __tablename__ = 'schema_version'
+
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.Text, nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return '<SchemaVersion {} "{}">'.format(self.version, self.name)
+
+
+class SeedFile(Base):
+    """ Manifest of seeded question files. Lets 'seed_questions_qsubjs' skip
+        files whose mtime and size, or content hash, have not changed.
+
+    """
+
+    __tablename__ = 'seed_files'
+
+    path = db.Column(db.Text, primary_key=True)
+    mtime = db.Column(db.Float, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    digest = db.Column(db.String(64), nullable=False)  # sha256 hex
+    q_id = db.Column(db.Integer, db.ForeignKey('questions.q_id'))
+
+    def __repr__(self):
+        return '<SeedFile "{}" q_id={}>'.format(self.path, self.q_id)
+
+
+################################################################################
+ ### Caches and Buffers ###
+
+class QuestionBank(object):
+    """ In-process cache of (q_id, difficulty) pairs indexed by (category,
+        difficulty), and by subject and (category, difficulty). Loaded with
+        two light queries on first use and shared by every QuestionSet; full
+        rows are fetched only by 'hydrate'. Call 'invalidate' whenever
+        questions or their subjects are created or edited.
+
+    """
+
+    def __init__(self):
+        self._index = None  # (levels, subjects) as built by 'load'
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        loaded = 'unloaded' if self._index is None else len(self._index[0])
+        return '<QuestionBank {}>'.format(loaded)
+
+
+    def get(self, category, difficulty, subjects=None, match_all=False):
+        """ Returns list of (q_id, difficulty) pairs of 'category' and
+            'difficulty'. Loads the bank first if necessary.
+
+            With 'subjects', an iterable of subject titles in any case, only
+            questions linked to any of them are returned, or to all of them
+            with 'match_all'. Work is proportional to the matching questions,
+            not the bank.
+
+        """
+
+        levels, by_subject = self._index or self.load()
+
+        if not subjects:
+            return levels.get((category, difficulty), [])
+
+        key = (category, difficulty)
+        sets = [by_subject.get(subject.lower(), {}).get(key, frozenset())
+                for subject in subjects]
+        if match_all:
+            pairs = frozenset.intersection(*sets)
+        else:
+            pairs = frozenset().union(*sets)
+
+        return list(pairs)
+
+
+    def get_subjects(self):
+        """ Returns set of the lowercased titles of subjects with questions.
+            Loads the bank first if necessary.
+
+        """
+
+        levels, by_subject = self._index or self.load()
+        return set(by_subject)
+
+
+    @track('QuestionBank.load')
+    def load(self):
+        """ Reads q_id, category and difficulty of every Question, and the
+            q_id and subject title of every Q_Subj, and indexes them. The text
+            and answer columns are never read. Threads that ask at once share
+            one load. Returns (levels, subjects) indexes.
+
+        """
+
+        with self._lock:
+            if self._index is not None:
+                return self._index
+
+            levels = {}
+            pairs = {}
+            rows = db.session.query(Question.q_id, Question.category,
+                                    Question.difficulty)
+            for q_id, category, difficulty in rows:
+                pair = (q_id, difficulty)
+                levels.setdefault((category, difficulty), []).append(pair)
+                pairs[q_id] = ((category, difficulty), pair)
+
+            subjects = {}
+            rows = (db.session.query(Subject.title, Q_Subj.q_id)
+                              .join(Q_Subj, Q_Subj.s_id == Subject.s_id))
+            for title, q_id in rows:
+                if q_id not in pairs:
+                    continue  # linked since the first query
+                key, pair = pairs[q_id]
+                (subjects.setdefault(title.lower(), {})
+                         .setdefault(key, set()).add(pair))
+            for by_level in subjects.values():
+                for key, subj_pairs in by_level.items():
+                    by_level[key] = frozenset(subj_pairs)
+
+            self._index = (levels, subjects)
+
+        return self._index
+
+
+    def hydrate(self, q_ids):
+        """ Returns list of full Questions for 'q_ids' in one query. """
+
+        if not q_ids:
+            return []
+
+        return Question.query.filter(Question.q_id.in_(list(q_ids))).all()
+
+
+    def invalidate(self):
+        """ Drops the cached index; the next 'get' reloads it. """
+
+        with self._lock:
+            self._index = None
+
+        return None
+
+
+question_bank = QuestionBank()
+
+
+class ScoreBuffer(object):
+    """ Write-behind buffer for score events. Points collected with 'add' are
+        written in one transaction by 'flush', which QuestionSets call when
+        they finish and the CLI calls on quit. 'score_buffer' is the console's
+        and is also flushed at exit; server sessions get their own, reporting
+        through their 'say'.
+
+    """
+
+    def __init__(self, say=print):
+        self._pending = []
+        self._lock = threading.Lock()
+        self._say = say
+
+    def __repr__(self):
+        return '<ScoreBuffer pending={}>'.format(len(self._pending))
+
+
+    def add(self, u_id=None, q_id=None, new_points=None):
+        """ Holds new points value for user-question pair until next flush. """
+
+        if not u_id or not q_id or new_points not in range(6):
+            return None
+
+        with self._lock:
+            self._pending.append({'u_id': u_id, 'q_id': q_id,
+                                  'points': new_points,
+                                  'created_at': datetime.datetime.utcnow()})
+
+        return None
+
+
+    @track('ScoreBuffer.flush')
+    def flush(self):
+        """ Inserts all held points in one executemany, updates ScoreStats
+            and commits. Points are kept for the next flush if the commit
+            fails. Returns count written.
+
+        """
+
+        with self._lock:
+            if not self._pending:
+                return 0
+
+            try:
+                db.session.execute(ScoreEvent.__table__.insert(),
+                                   self._pending)
+                ScoreStat.record(self._pending)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+            flushed = len(self._pending)
+            self._pending = []
+
+        self._say("Scores updated!")
+        return flushed
+
+
+score_buffer = ScoreBuffer()
+atexit.register(score_buffer.flush)
+
+
 ################################################################################
  ### Helper Functions ###
 
-def make_qs_id(q_id, s_id):
-    """ Makes Q_Subj id for all functions. """
-    return int(str(q_id) + str(s_id))
+def make_question_row(title, text, attrs):
+    """ Makes Question column dict for bulk inserts. Mirrors the defaults in
+        Question.__init__ so every row in a batch has the same keys.
+
+    """
+
+    return {'title': title,
+            'text': text,
+            'difficulty': attrs.get('difficulty', 2),
+            'durations': attrs.get('durations', [180]),
+            'category': attrs.get('category', "T"),
+            'answer': attrs.get('answer', None)}
 
 
 def make_score_id(u_id, q_id):
@@ -350,6 +1254,60 @@ def make_score_id(u_id, q_id):
     return u_id + '--' + str(q_id)
 
 
+def make_stat_id(u_id=None, q_id=None):
+    """ Makes ScoreStat id for a user, a question or a user-question pair. """
+
+    if u_id and q_id:
+        return 'uq:' + make_score_id(u_id, q_id)
+    elif u_id:
+        return 'u:' + u_id
+    return 'q:' + str(q_id)
+
+
+def supports_upsert():
+    """ Returns True if the DB has INSERT ... ON CONFLICT: PostgreSQL, and
+        SQLite from 3.24.
+
+    """
+
+    if db.engine.dialect.name == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return db.engine.dialect.name == 'postgresql'
+
+
+def parse_int_list(text):
+    """ Parses comma-separated integers, as in '120,60,', to a list. """
+    return [int(val) for val in text.split(',') if val.strip()]
+
+
+def make_leader_id(board, u_id):
+    """ Makes LeaderStat id for a user on a board. """
+    return board + '|' + u_id
+
+
+def make_board(category=None, s_id=None):
+    """ Makes LeaderStat board name: a category's, a subject's or 'all'. """
+
+    if category:
+        return 'c:' + category
+    elif s_id:
+        return 's:' + str(s_id)
+    return 'all'
+
+
+def iter_batches(items, size):
+    """ Yields lists of up to 'size' items from any iterable. """
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 ################################################################################
  ### Database Functions ###
 
@@ -369,6 +1327,7 @@ def seed_data():
     """ Seed data """
 
     db.create_all()  # does nothing to already created tables
+    create_search_index()
     seed_subjects()
     # questions with qs_subjs
     # users: add 'default'?
@@ -376,42 +1335,439 @@ def seed_data():
     return None
 
 
-def seed_subjects():
-    """ Reads subjects in from path. Original list brainstormed with amsowie. """
+def migrate_score_points():
+    """ Moves comma-separated 'Score.points' histories into ScoreEvent rows,
+        SEED_BATCH_SIZE rows per INSERT. The original times are unknown, so
+        events share the migration time; their order is kept by event_id.
+        Migrated 'points' are cleared so this can safely be run again.
+        ScoreStats are built from the migrated events as they are inserted.
+
+    """
+
+    now = datetime.datetime.utcnow()
+    scores = (db.session.query(Score.score_id, Score.u_id, Score.q_id,
+                               Score.points)
+                        .filter(Score.points != '')
+                        .order_by(Score.score_id)
+                        .all())
+
+    events = ({'u_id': u_id, 'q_id': q_id, 'points': int(points),
+               'created_at': now}
+              for score_id, u_id, q_id, history in scores
+              for points in history.split(',') if points.strip())
+    migrated = 0
+    for batch in iter_batches(events, SEED_BATCH_SIZE):
+        db.session.execute(ScoreEvent.__table__.insert(), batch)
+        ScoreStat.record(batch)
+        migrated += len(batch)
+
+    (Score.query.filter(Score.points != '')
+                .update({'points': ''}, synchronize_session=False))
+    db.session.commit()
+    print("\n-- Migrated {} scores from {} histories. --\n"
+          .format(migrated, len(scores)))
+
+    return migrated
+
+
+def migrate_qs_subjs_key():
+    """ Rebuilds a qs_subjs table keyed by the old concatenated 'qs_id' with
+        the composite (q_id, s_id) key and its s_id index, keeping each
+        distinct link. Runs in one transaction and does nothing if the table
+        already has the new key, so it can safely be run again.
+
+    """
+
+    columns = [column['name'] for column
+               in db.inspect(db.engine).get_columns(Q_Subj.__tablename__)]
+    if 'qs_id' not in columns:
+        return 0
+
+    with db.engine.begin() as conn:
+        links = [{'q_id': q_id, 's_id': s_id} for q_id, s_id
+                 in conn.execute("SELECT DISTINCT q_id, s_id FROM qs_subjs")]
+        conn.execute("DROP TABLE qs_subjs")
+        Q_Subj.__table__.create(conn)
+        for batch in iter_batches(links, SEED_BATCH_SIZE):
+            conn.execute(Q_Subj.__table__.insert(), batch)
+
+    print("\n-- Migrated {} subject links to the (q_id, s_id) key. --\n"
+          .format(len(links)))
+
+    return len(links)
+
+
+def rebuild_leaderboard():
+    """ Refills LeaderStats from all ScoreEvents with three aggregate
+        INSERT ... SELECTs, one per kind of board, in one transaction. For
+        DBs with scores from before the leaderboard, or to repair it; score
+        writes keep it current otherwise. Returns count of rows written.
+
+    """
+
+    aggregates = ("count(*), sum(e.points), avg(e.points), max(e.points), "
+                  "max(e.created_at)")
+    boards = [("'all'", "", "e.u_id"),
+              ("'c:' || q.category",
+               "JOIN questions q ON q.q_id = e.q_id",
+               "e.u_id, q.category"),
+              ("'s:' || CAST(qs.s_id AS TEXT)",
+               "JOIN qs_subjs qs ON qs.q_id = e.q_id",
+               "e.u_id, qs.s_id")]
+
+    with db.engine.begin() as conn:
+        conn.execute(LeaderStat.__table__.delete())
+        for board, join, group_by in boards:
+            conn.execute("INSERT INTO leader_stats (leader_id, board, u_id, "
+                         "count, total, mean, best, updated_at) "
+                         "SELECT {board} || '|' || e.u_id, {board}, e.u_id, "
+                         "{aggregates} FROM score_events e {join} "
+                         "GROUP BY {group_by}"
+                         .format(board=board, aggregates=aggregates,
+                                 join=join, group_by=group_by))
+        count = conn.execute(db.select([db.func.count()])
+                               .select_from(LeaderStat.__table__)).scalar()
+
+    print("\n-- Rebuilt leaderboard: {} user boards. --\n".format(count))
+
+    return count
+
+
+@track('seed_subjects')
+def seed_subjects(bulk=True):
+    """ Reads subjects in from path. Original list brainstormed with amsowie.
+
+        With 'bulk', existing subjects are read in one query and new ones are
+        inserted in batches; prints and returns (inserted, skipped) counts.
+
+    """
 
     with open('data/subjects.txt') as f:
         subjects = f.readlines()
 
-    for subj in subjects:
-        Subject.create(subj.strip())
+    if not bulk:
+        for subj in subjects:
+            Subject.create(subj.strip())
+        print("\n-- Finished seeding subjects. --\n")
+        return None
 
-    print("\n-- Finished seeding subjects. --\n")
+    rows = ({'title': subj.strip()} for subj in subjects)
+    inserted, skipped = Subject.bulk_create(col='title', rows=rows)
+    print("\n-- Finished seeding subjects: {} inserted, {} skipped. --\n"
+          .format(inserted, skipped))
 
-    return None
+    return (inserted, skipped)
 
 
-def seed_questions_qsubjs():
-    """ Reads all .txt files in the /data/questions directory.
+@track('seed_questions_qsubjs')
+def seed_questions_qsubjs(bulk=True, processes=None, retire=False,
+                          file_dir='./data/questions'):
+    """ Reads all .txt files in the /data/questions directory, or 'file_dir'.
 
         Code sampled from http://stackabuse.com/python-list-files-in-a-directory/
 
+        With 'bulk', files are first checked against the SeedFile manifest.
+        Files with unchanged mtime and size are not opened; files with an
+        unchanged content hash are not written. The rest are parsed in
+        parallel ('processes' is passed to 'parse_question_files') and handled
+        SEED_BATCH_SIZE at a time: new questions and their Q_Subj links are
+        bulk inserted, and changed questions are updated and relinked.
+        Files without a title or text, with the title of another file's
+        question, or changed to another question's title, are skipped and
+        retried on the next run. Subjects missing from
+        the DB are not created; their links are left out and the subjects
+        listed. With 'retire', questions whose files were deleted are
+        removed with their links, unless they have scores.
+
+        Prints and returns dict of counts keyed by table name or action.
+
     """
 
     # Get set of class attributes
     attr_keys = [attr.upper() for attr in Question.__table__.columns.keys()]
 
     # Define the path
-    file_dir = pathlib.Path('./data/questions')
+    file_dir = pathlib.Path(file_dir)
+
+    if not bulk:
+        records = (parse_question_file(file, attr_keys)
+                   for file in file_dir.glob('*.txt'))
+        for title, text, attrs, subjs in records:
+            new_question = Question.create(title, text, attrs)
+            if new_question:
+                new_question.add_subjects(subjs)
+        return None  # file
+
+    # One existence lookup per table
+    manifest = {path: (mtime, size, digest, q_id) for path, mtime, size,
+                digest, q_id in db.session.query(SeedFile.path, SeedFile.mtime,
+                                                 SeedFile.size, SeedFile.digest,
+                                                 SeedFile.q_id)}
+    titles = set(title for (title,) in db.session.query(Question.title))
+    s_ids = dict(db.session.query(Subject.title, Subject.s_id))
+    owners = {entry[3]: path for path, entry in manifest.items() if entry[3]}
+
+    counts = {'questions': [0, 0], 'qs_subjs': [0, 0],
+              'updated': 0, 'unchanged': 0, 'retired': 0}
+    missing = set([])
+    invalid = []  # paths of files without a title or text, or with a taken one
+    stats = {}
+
+    files = iter_changed_files(file_dir, manifest, stats)
+    records = parse_question_files(files, attr_keys, processes=processes,
+                                   digest=True)
+
+    for batch in iter_batches(records, SEED_BATCH_SIZE):
+        inserts = []
+        updates = []
+        seen = []
+        claimed = set([])  # titles of earlier files in this batch
+        for path, digest, record in batch:
+            old = manifest.get(path)
+            if old and old[2] == digest:
+                seen.append((path, digest, old[3]))
+                counts['unchanged'] += 1
+            elif not record[0] or not record[1] or record[0] in claimed:
+                invalid.append(path)  # left out of the manifest; retried
+            elif (old and old[3]) or record[0] in titles:
+                updates.append((path, digest, record))
+            else:
+                inserts.append((path, digest, record))
+            claimed.add(record[0])
+
+        # New questions: bulk insert, then look up their ids once
+        new_subjs = {record[0]: record[3] for path, digest, record in inserts
+                     if record[0] and record[0] not in titles}
+        rows = [make_question_row(*record[:3])
+                for path, digest, record in inserts]
+        inserted, skipped = Question.bulk_create(col='title', rows=rows,
+                                                 existing=titles)
+        counts['questions'][0] += inserted
+        counts['questions'][1] += skipped
+
+        new_ids = {}
+        if new_subjs:
+            new_ids = dict(db.session.query(Question.title, Question.q_id)
+                                     .filter(Question.title
+                                                     .in_(list(new_subjs))))
+        links = make_qs_rows(new_ids, new_subjs, s_ids, missing)
+        seen.extend((path, digest, new_ids.get(record[0]))
+                    for path, digest, record in inserts)
+
+        # Changed questions: update in place and replace their links
+        if updates:
+            upd_ids = [manifest[path][3] for path, digest, record in updates
+                       if path in manifest and manifest[path][3]]
+            upd_titles = [record[0] for path, digest, record in updates]
+            questions = (Question.query
+                                 .filter(db.or_(Question.q_id.in_(upd_ids),
+                                                Question.title
+                                                        .in_(upd_titles)))
+                                 .all())
+            by_id = {question.q_id: question for question in questions}
+            by_title = {question.title: question for question in questions}
+
+            upd_subjs = {}
+            for path, digest, record in updates:
+                old = manifest.get(path)
+                question = (by_id.get(old[3]) if old and old[3]
+                            else by_title.get(record[0]))
+                if not question:
+                    continue
+                if record[0] != question.title and record[0] in titles:
+                    invalid.append(path)  # title of another question
+                    continue
+                owner = owners.get(question.q_id, path)
+                if owner != path and pathlib.Path(owner).exists():
+                    invalid.append(path)  # question of another file
+                    continue
+                titles.discard(question.title)
+                for key, val in make_question_row(*record[:3]).items():
+                    setattr(question, key, val)
+                titles.add(question.title)
+                upd_subjs[question.q_id] = record[3]
+                seen.append((path, digest, question.q_id))
+                counts['updated'] += 1
+            db.session.commit()
+
+            upd_links = make_qs_rows({q_id: q_id for q_id in upd_subjs},
+                                     upd_subjs, s_ids, missing)
+            keep = set((link['q_id'], link['s_id']) for link in upd_links)
+            linked = (db.session.query(Q_Subj.q_id, Q_Subj.s_id)
+                                .filter(Q_Subj.q_id.in_(list(upd_subjs))))
+            stale = {}  # s_id: q_ids; one condition per subject
+            for q_id, s_id in linked:
+                if (q_id, s_id) not in keep:
+                    stale.setdefault(s_id, []).append(q_id)
+            if stale:
+                (Q_Subj.query.filter(db.or_(*(db.and_(Q_Subj.s_id == s_id,
+                                                      Q_Subj.q_id.in_(q_ids))
+                                              for s_id, q_ids in stale.items())))
+                             .delete(synchronize_session=False))
+            links.extend(upd_links)
+
+        inserted, skipped = Q_Subj.link(links)
+        counts['qs_subjs'][0] += inserted
+        counts['qs_subjs'][1] += skipped
+
+        update_manifest(manifest, stats, seen)
+        owners.update((q_id, path) for path, digest, q_id in seen if q_id)
+
+    # Files in the manifest that no longer exist on disk
+    gone = [path for path in manifest if path not in stats]
+    if gone and retire:
+        counts['retired'] = retire_questions(manifest, gone)
+    elif gone:
+        print("{} question files were deleted; ".format(len(gone)) +
+              "re-seed with 'retire=True' to remove their questions.")
+
+    question_bank.invalidate()
+
+    counts['questions'][1] += len(invalid)
+    if invalid:
+        print("Files without a title or text, or with another question's "
+              "title, skipped: {}".format(", ".join(sorted(invalid))))
+    if missing:
+        print("Subjects not in DB, links skipped: {}"
+              .format(", ".join(sorted(missing))))
+    print("\n-- Finished seeding questions: {} inserted, {} skipped, ".format(
+          *counts['questions']) +
+          "{updated} updated, {unchanged} unchanged, {retired} retired; "
+          .format(**counts) +
+          "links: {} inserted, {} skipped. --\n".format(*counts['qs_subjs']))
+
+    return {key: tuple(count) if isinstance(count, list) else count
+            for key, count in counts.items()}
+
+
+def iter_changed_files(file_dir, manifest, stats):
+    """ Yields .txt files in 'file_dir' whose (mtime, size) differ from their
+        'manifest' entry. Records (mtime, size) of every file in 'stats'.
+
+    """
 
     for file in file_dir.glob('*.txt'):
-        # if file.name == '_template.txt':
-        #     continue
-        title, text, attrs, subjs = parse_question_file(file, attr_keys)
-        new_question = Question.create(title, text, attrs)
-        if new_question:
-            new_question.add_subjects(subjs)
+        path = str(file)
+        stat = file.stat()
+        stats[path] = (stat.st_mtime, stat.st_size)
+        old = manifest.get(path)
+        if old and old[:2] == stats[path]:
+            continue
+        yield file
 
-    return None  # file
+
+def make_qs_rows(q_ids, subjs, s_ids, missing):
+    """ Makes Q_Subj column dicts for bulk inserts. 'q_ids' maps a key to a
+        q_id, 'subjs' maps the same key to subject titles and 's_ids' maps
+        subject titles to s_ids. Unknown subject titles are added to 'missing'.
+
+    """
+
+    rows = []
+    for key, q_id in q_ids.items():
+        for subj in subjs.get(key, []):
+            if subj not in s_ids:
+                missing.add(subj)
+                continue
+            rows.append({'q_id': q_id, 's_id': s_ids[subj]})
+
+    return rows
+
+
+def update_manifest(manifest, stats, seen):
+    """ Writes (path, digest, q_id) entries of 'seen' files to the SeedFile
+        table in two executemany statements and commits. Keeps 'manifest' in
+        step.
+
+    """
+
+    new_rows = []
+    old_rows = []
+    for path, digest, q_id in seen:
+        mtime, size = stats[path]
+        if path in manifest:
+            old_rows.append({'b_path': path, 'b_mtime': mtime, 'b_size': size,
+                             'b_digest': digest, 'b_q_id': q_id})
+        else:
+            new_rows.append({'path': path, 'mtime': mtime, 'size': size,
+                             'digest': digest, 'q_id': q_id})
+        manifest[path] = (mtime, size, digest, q_id)
+
+    table = SeedFile.__table__
+    if new_rows:
+        db.session.execute(table.insert(), new_rows)
+    if old_rows:
+        db.session.execute(table.update()
+                                .where(table.c.path == db.bindparam('b_path'))
+                                .values(mtime=db.bindparam('b_mtime'),
+                                        size=db.bindparam('b_size'),
+                                        digest=db.bindparam('b_digest'),
+                                        q_id=db.bindparam('b_q_id')),
+                           old_rows)
+    db.session.commit()
+
+    return None
+
+
+def retire_questions(manifest, gone):
+    """ Removes questions, Q_Subj links and SeedFile entries for the deleted
+        files in 'gone'. Questions with scores, or still seeded from another
+        file, are kept. Returns count removed.
+
+    """
+
+    gone = set(gone)
+    kept = set(entry[3] for path, entry in manifest.items()
+               if path not in gone)
+    q_ids = list(set(manifest[path][3] for path in gone
+                     if manifest[path][3] and manifest[path][3] not in kept))
+    scored = set(q_id for model in (Score, ScoreEvent)
+                 for (q_id,) in (db.session.query(model.q_id)
+                                           .filter(model.q_id.in_(q_ids))
+                                           .distinct()))
+    if scored:
+        print("Keeping {} questions with scores whose files were deleted."
+              .format(len(scored)))
+
+    retired = [q_id for q_id in q_ids if q_id not in scored]
+    paths = [path for path in gone if manifest[path][3] not in scored]
+
+    if paths:
+        (SeedFile.query.filter(SeedFile.path.in_(paths))
+                       .delete(synchronize_session=False))
+    if retired:
+        (Q_Subj.query.filter(Q_Subj.q_id.in_(retired))
+                     .delete(synchronize_session=False))
+        (Question.query.filter(Question.q_id.in_(retired))
+                       .delete(synchronize_session=False))
+    db.session.commit()
+
+    for path in paths:
+        del manifest[path]
+
+    return len(retired)
+
+
+def parse_question_files(files, attr_keys, processes=None, digest=False):
+    """ Yields (title, text, attrs, subjs) for each file in the iterable
+        'files', in order of completion rather than input order. Files are
+        parsed in a process pool of 'processes' workers (CPU count if None);
+        with processes=1 they are parsed in this process. With 'digest',
+        yields (path, sha256 hex digest, record) instead.
+
+    """
+
+    parse = digest_question_file if digest else parse_question_file
+
+    if processes == 1:
+        for file in files:
+            yield parse(file, attr_keys)
+        return
+
+    parse = functools.partial(parse, attr_keys=attr_keys)
+    with multiprocessing.Pool(processes) as pool:
+        for record in pool.imap_unordered(parse, files, PARSE_CHUNKSIZE):
+            yield record
 
 
 def parse_question_file(file, attr_keys):
@@ -420,13 +1776,40 @@ def parse_question_file(file, attr_keys):
 
     """
 
+    with open(file) as f:
+        return parse_question_lines(f, attr_keys)
+
+
+def digest_question_file(file, attr_keys):
+    """ Parses file while hashing its bytes in the same single read. Returns
+        (path, sha256 hex digest, record) for the manifest.
+
+    """
+
+    hasher = hashlib.sha256()
+
+    def hashed_lines(f):
+        for line in f:
+            hasher.update(line)
+            yield line.decode()
+
+    with open(file, 'rb') as f:
+        record = parse_question_lines(hashed_lines(f), attr_keys)
+
+    return (str(file), hasher.hexdigest(), record)
+
+
+def parse_question_lines(lines, attr_keys):
+    """ Parses an iterable of question file lines one at a time. Returns the
+        same tuple as 'parse_question_file'.
+
+    """
+
     title = None
     text = None
     attrs = {}
     subjs = []
-
-    with open(file) as f:
-        lines = f.readlines()
+    attr = None
 
     # Looks line-by-line for matching class attributes
     # Only 'text' and 'answer' attrs are permitted multi-line values
@@ -450,15 +1833,131 @@ def parse_question_file(file, attr_keys):
     return (title, text, attrs, subjs)
 
 
-def connect_to_db(app):
-    """ Connect the database to a Flask app. """
+def create_search_index():
+    """ Creates the full-text search index used by Question.search if it is
+        missing: a GIN expression index on PostgreSQL, or an FTS5 table and
+        sync triggers on SQLite. The FTS5 table is refilled from the questions
+        table whenever its triggers were missing.
+
+    """
+
+    dialect = db.engine.dialect.name
+    if dialect not in SEARCH_DDL:
+        return None
+
+    # Triggers go when the questions table is dropped; the FTS table doesn't
+    fill = (dialect == 'sqlite' and
+            db.engine.execute("SELECT count(*) FROM sqlite_master WHERE "
+                              "name = 'questions_fts_ai'").scalar() == 0)
+
+    with db.engine.begin() as conn:
+        for ddl in SEARCH_DDL[dialect]:
+            conn.execute(ddl)
+        if fill:
+            conn.execute("INSERT INTO questions_fts(questions_fts) "
+                         "VALUES ('rebuild')")
+
+    return None
+
+
+def validate_engine_options(options):
+    """ Raises ValueError naming the first unknown or out-of-range option in
+        the 'options' dict.
+
+    """
+
+    for key, val in options.items():
+        if key not in ENGINE_OPTION_CHECKS:
+            raise ValueError("Unknown engine option '{}'. Expected one of: {}."
+                             .format(key, ", ".join(sorted(
+                                                    ENGINE_OPTION_CHECKS))))
+        if not ENGINE_OPTION_CHECKS[key](val):
+            raise ValueError("Bad value for engine option '{}': {!r}."
+                             .format(key, val))
+
+    return None
+
+
+def warm_pool(size=None):
+    """ Opens 'size' connections at once, the pool size by default, runs a
+        trivial query on each and returns them to the pool, so the first
+        queries of a game don't pay for connection setup. Returns count.
+
+    """
+
+    pool = db.engine.pool
+    size = size or (pool.size() if hasattr(pool, 'size') else 1)
+
+    connections = [db.engine.connect() for i in range(size)]
+    for connection in connections:
+        connection.execute('SELECT 1')
+    for connection in connections:
+        connection.close()
+
+    return size
+
+
+def connect_to_db(app, db_uri=None, engine_options=None, warm=True,
+                  instrument=False, migrate=True):
+    """ Connect the database to a Flask app.
+
+        'db_uri' is a SQLAlchemy URI or a key of DB_URIS: 'postgres' for the
+        shared PostgreSQL DB, 'sqlite' for an embedded file DB in WAL mode or
+        'memory' for a throwaway in-memory DB. Defaults to $CLIJ_DATABASE_URI,
+        then PostgreSQL.
+
+        'engine_options' override the backend's ENGINE_OPTIONS (pool size,
+        overflow, timeout, recycle, pre-ping, batch mode, connect args) and
+        are validated before the engine is built. With 'warm', the pool is
+        filled before returning.
+
+        With 'instrument' or $CLIJ_INSTRUMENT set, statements are counted per
+        tracked operation in 'query_stats'.
 
-    # Configure to use PostgreSQL database
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///cliijeopardy'
+        With 'migrate', missing tables are created and the schema is brought
+        up to date by 'migrations.upgrade'.
+
+    """
+
+    db_uri = db_uri or os.environ.get('CLIJ_DATABASE_URI', 'postgres')
+    options = dict(app.config.get('CLIJ_ENGINE_OPTIONS', {}),
+                   **(engine_options or {}))
+    validate_engine_options(options)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = DB_URIS.get(db_uri, db_uri)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['CLIJ_ENGINE_OPTIONS'] = options
     db.app = app
     db.init_app(app)
-    db.create_all()  # does nothing to already created tables
+
+    if instrument or os.environ.get('CLIJ_INSTRUMENT'):
+        query_stats.enable(db.engine)
+
+    if migrate:
+        from migrations import upgrade  # migrations imports this module
+        upgrade()
+
+    if warm:
+        warm_pool()
+
+
+@db.event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """ Makes SQLite enforce foreign keys like PostgreSQL, and puts file DBs
+        in WAL mode so readers don't block the writer.
+
+    """
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return None
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.execute('PRAGMA journal_mode=WAL')  # stays 'memory' for :memory:
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+    return None
 
 
 if __name__ == '__main__':
@@ -470,6 +1969,3 @@ if __name__ == '__main__':
     # Connect to DB
     connect_to_db(app)
     print("\n-- Working directly in database. Use Flask-SQLAlchemy syntax. --\n")
-
-    # Set constants
-    QATTR_RE = re.compile(r'^[A-Z]{4,10}(?=:)')  # 4 to 10 A-Z chars, then ':'
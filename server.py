@@ -0,0 +1,229 @@
+""" Session Server """
+
+# Hosts many players' sessions in one process over a line-based TCP protocol:
+#
+#   python server.py --port 7373 --db postgres
+#   nc localhost 7373
+#
+# asyncio owns the sockets. Each connection gets its own clij Session, whose
+# greet/username/Game/play-again flow and DB work run on a worker thread with
+# its own scoped DB session and ScoreBuffer. The worker hands every prompt and
+# reply to the event loop, and releases its DB connection while it waits for
+# the player, so idle players hold neither the loop nor the pool. A session
+# holds its worker thread throughout, so at most --max-sessions are played at
+# once; players beyond that are told the server is full and disconnected.
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import traceback
+
+import clij
+
+
+FULL_MSG = ("\n\nSorry, all {} seats at Command Line Interview Jeopardy are "
+            "taken. Please try again soon!\n\n")
+ERROR_MSG = "\nSorry, something went wrong on my end. Please try again soon!"
+LOST_MSG = "\nSorry, I couldn't save your latest scores."
+
+
+class LineIO(object):
+    """ Bridges a worker thread's 'ask' and 'say' calls to a connection's
+        asyncio streams.
+
+    """
+
+    def __init__(self, reader, writer, loop):
+        self._reader = reader
+        self._writer = writer
+        self._loop = loop
+
+    def __repr__(self):
+        return '<LineIO {}>'.format(self._writer.get_extra_info('peername'))
+
+
+    def say(self, msg=''):
+        """ Sends a message line to the player. """
+
+        self._send(str(msg) + '\n')
+        return None
+
+
+    def ask(self, prompt):
+        """ Sends a prompt and waits for the player's reply line. Returns 'q'
+            if the player disconnects.
+
+        """
+
+        self._send(prompt)
+
+        # Don't hold a pooled connection while the player thinks; loaded
+        # objects stay usable once detached
+        clij.model.db.session.close()
+
+        line = asyncio.run_coroutine_threadsafe(self._reader.readline(),
+                                                self._loop).result()
+        if not line:
+            return 'q'
+
+        return line.decode(errors='replace').strip()
+
+
+    def _send(self, text):
+        asyncio.run_coroutine_threadsafe(self._write(text),
+                                         self._loop).result()
+
+
+    async def _write(self, text):
+        self._writer.write(text.encode())
+        await self._writer.drain()
+
+
+class Seats(asyncio.Semaphore):
+    """ Semaphore of the sessions that may be played at once; knows its size
+        for the server-full message.
+
+    """
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.size = size
+
+    def __repr__(self):
+        return '<Seats size={}>'.format(self.size)
+
+
+def serve_session(session):
+    """ Runs one player's session on a worker thread. Always tries to write
+        their buffered scores and returns the thread's DB session. Errors,
+        including a failed final flush, are logged and the player is told.
+
+    """
+
+    try:
+        clij.greet_user(session)
+        session.user = clij.get_username(session)
+        clij.play_games(session)
+        clij.dismiss_user(session)
+    except ConnectionError:
+        pass  # player hung up; keep their scores below
+    except Exception:
+        log_error(session, "session failed")
+        tell(session, ERROR_MSG)
+    finally:
+        try:
+            session.scores.flush()
+        except ConnectionError:
+            pass  # written; only "Scores updated!" didn't reach the player
+        except Exception:
+            log_error(session, "scores not saved")
+            tell(session, LOST_MSG)
+        clij.model.db.session.remove()
+
+    return None
+
+
+def tell(session, msg):
+    """ Says 'msg' to the player if they are still connected. """
+
+    try:
+        session.say(msg)
+    except ConnectionError:
+        pass
+
+    return None
+
+
+def log_error(session, what):
+    """ Prints what went wrong in the session and the current traceback. """
+
+    print("-- Session of {}: {} --".format(session.user, what))
+    traceback.print_exc()
+
+    return None
+
+
+async def handle_connection(reader, writer, executor, seats, review=False):
+    """ Starts a session for a new connection and closes it when done. Turns
+        the player away if the 'seats' semaphore has none left.
+
+    """
+
+    if seats.locked():
+        writer.write(FULL_MSG.format(seats.size).encode())
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+        return None
+
+    async with seats:
+        loop = asyncio.get_running_loop()
+        line_io = LineIO(reader, writer, loop)
+
+        session = clij.Session(ask=line_io.ask, say=line_io.say,
+                               review=review)
+        session.scores = clij.model.ScoreBuffer(say=line_io.say)
+
+        try:
+            await loop.run_in_executor(executor, serve_session, session)
+        finally:
+            writer.close()
+
+    return None
+
+
+async def serve(host, port, max_sessions, review=False):
+    """ Accepts connections until cancelled, with up to 'max_sessions' games
+        running at once; later players are told the server is full.
+
+    """
+
+    executor = ThreadPoolExecutor(max_workers=max_sessions)
+    seats = Seats(max_sessions)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, executor,
+                                                 seats, review),
+        host, port)
+
+    print("-- Serving Command Line Interview Jeopardy on {}:{} --"
+          .format(host, port))
+    try:
+        await server.serve_forever()
+    finally:
+        server.close()
+        executor.shutdown(wait=False)
+
+
+################################################################################
+### Run Server ###
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Serve Command Line "
+                                                 "Interview Jeopardy sessions")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7373)
+    parser.add_argument('--max-sessions', type=int, default=256,
+                        help="games played at once; more players are "
+                             "turned away")
+    parser.add_argument('--review', action='store_true',
+                        help="ask each player's most overdue questions first")
+    parser.add_argument('--db', default=None,
+                        help="'postgres', 'sqlite', 'memory' or a database URI"
+                             " (default: $CLIJ_DATABASE_URI or 'postgres')")
+    parser.add_argument('--instrument', action='store_true',
+                        help="count SQL statements per operation and print "
+                             "a summary on shutdown")
+    args = parser.parse_args()
+
+    clij.load_backend(args.db, args.instrument)
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.max_sessions,
+                          args.review))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        clij.report_queries()
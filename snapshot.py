@@ -0,0 +1,284 @@
+""" Question Bank Snapshots """
+
+# A snapshot is a read-only copy of the question bank in one file, for play
+# with no database:
+#
+#   python clij.py --export-snapshot bank.snap    # needs the DB
+#   python clij.py --snapshot bank.snap           # doesn't
+#
+# Layout, all integers little-endian:
+#
+#   header     magic, directory offset and length
+#   text       each question's title, text and answer, UTF-8, back to back
+#   ids        q_ids, ascending, uint32
+#   records    one RECORD per q_id: difficulty, category and text lengths
+#   pools      q_ids per (category, difficulty) and per subject and
+#              (category, difficulty), uint32
+#   directory  JSON: counts, and offset and length of each section and pool
+#
+# SnapshotBank memory-maps the file and reads it in place, so opening is
+# near-instant and the OS shares its pages between processes.
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from collections.abc import Sequence
+import json
+import mmap
+import os
+import struct
+import sys
+
+from model import db, Question, Q_Subj, Subject
+
+
+MAGIC = b'CLIJSNP1'
+HEADER = struct.Struct('<8sQI')  # magic, directory offset, directory length
+RECORD = struct.Struct('<Bc2xQIIi')  # difficulty, category, pad, text offset,
+                                     # title, text and answer lengths; -1 for
+                                     # a missing answer
+
+SnapshotQuestion = namedtuple('SnapshotQuestion', 'q_id title text answer '
+                                                  'difficulty category')
+
+
+class SnapshotBank(object):
+    """ Read-only question bank served from a memory-mapped snapshot file. Has
+        QuestionBank's 'get', 'get_subjects', 'hydrate' and 'invalidate'.
+
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise ValueError("Snapshots are little-endian; this machine "
+                             "isn't.")
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, dir_offset, dir_len = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError("'{}' is not a question bank snapshot."
+                             .format(path))
+        self._dir = json.loads(self._mmap[dir_offset:dir_offset + dir_len]
+                                   .decode())
+        self._path = path
+        self._ids = self._get_ids(self._dir['ids'])
+        self._records = self._dir['records']
+
+    def __repr__(self):
+        return '<SnapshotBank {} questions={}>'.format(self._path,
+                                                      len(self._ids))
+
+
+    def get(self, category, difficulty, subjects=None, match_all=False):
+        """ Returns sequence of (q_id, difficulty) pairs of 'category' and
+            'difficulty', optionally only those linked to any, or with
+            'match_all' all, of 'subjects'. See QuestionBank.get.
+
+        """
+
+        key = make_pool_key(category, difficulty)
+
+        if not subjects:
+            span = self._dir['levels'].get(key)
+            return PairArray(self._get_ids(span) if span else (), difficulty)
+
+        pools = self._dir['subjects']
+        sets = [set(self._get_ids(pools.get(subject.lower(), {}).get(key,
+                                                                    [0, 0])))
+                for subject in subjects]
+        if match_all:
+            q_ids = set.intersection(*sets)
+        else:
+            q_ids = set().union(*sets)
+
+        return [(q_id, difficulty) for q_id in q_ids]
+
+
+    def get_subjects(self):
+        """ Returns set of the lowercased titles of subjects with questions. """
+
+        return set(self._dir['subjects'])
+
+
+    def hydrate(self, q_ids):
+        """ Returns list of SnapshotQuestions for 'q_ids', read in place. """
+
+        questions = []
+        for q_id in q_ids:
+            i = bisect_left(self._ids, q_id)
+            if i < len(self._ids) and self._ids[i] == q_id:
+                questions.append(self._read_question(i))
+
+        return questions
+
+
+    def invalidate(self):
+        """ Does nothing; snapshots are read-only. """
+
+        return None
+
+
+    def _get_ids(self, span):
+        """ Returns the uint32 array at 'span', (offset, count), as a
+            memoryview of the mapped file.
+
+        """
+
+        offset, count = span
+        return memoryview(self._mmap)[offset:offset + 4 * count].cast('I')
+
+
+    def _read_question(self, i):
+        difficulty, category, offset, title_len, text_len, answer_len = (
+            RECORD.unpack_from(self._mmap, self._records + i * RECORD.size))
+
+        def read(length):
+            nonlocal offset
+            val = self._mmap[offset:offset + length].decode()
+            offset += length
+            return val
+
+        title = read(title_len)
+        text = read(text_len)
+        answer = read(answer_len) if answer_len >= 0 else None
+
+        return SnapshotQuestion(self._ids[i], title, text, answer, difficulty,
+                                category.decode())
+
+
+class PairArray(Sequence):
+    """ (q_id, difficulty) pairs over an array of q_ids of one difficulty,
+        without copying it; 'random.sample' and 'nlargest' take it as a list.
+
+    """
+
+    def __init__(self, q_ids, difficulty):
+        self._q_ids = q_ids
+        self._difficulty = difficulty
+
+    def __repr__(self):
+        return '<PairArray difficulty={} len={}>'.format(self._difficulty,
+                                                         len(self))
+
+    def __len__(self):
+        return len(self._q_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [(q_id, self._difficulty) for q_id in self._q_ids[i]]
+        return (self._q_ids[i], self._difficulty)
+
+
+class NullScoreBuffer(object):
+    """ Stands in for ScoreBuffer when playing from a snapshot; points are
+        not kept.
+
+    """
+
+    def __init__(self, say=print):
+        self._say = say
+        self._warned = False
+
+    def __repr__(self):
+        return '<NullScoreBuffer>'
+
+
+    def add(self, u_id=None, q_id=None, new_points=None):
+        """ Drops the points, saying so once. """
+
+        if not self._warned:
+            self._say("(Playing from a snapshot; scores aren't saved.)")
+            self._warned = True
+
+        return None
+
+
+    def flush(self):
+        """ Does nothing. """
+
+        return None
+
+
+################################################################################
+ ### Export ###
+
+def export_snapshot(path):
+    """ Writes every question, its subjects and the pool indexes to a
+        snapshot file at 'path', replacing it once complete. Reads the DB.
+        Returns count of questions written.
+
+    """
+
+    if sys.byteorder != 'little':
+        raise ValueError("Snapshots are little-endian; export them on a "
+                         "little-endian machine.")
+
+    tmp_path = path + '.tmp'
+    q_ids = array('I')
+    records = []
+    levels = {}
+    by_q_id = {}
+
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+
+        # Text, streamed in q_id order
+        rows = (db.session.query(Question.q_id, Question.title, Question.text,
+                                 Question.answer, Question.difficulty,
+                                 Question.category)
+                          .order_by(Question.q_id)
+                          .yield_per(1000))
+        for q_id, title, text, answer, difficulty, category in rows:
+            offset = f.tell()
+            parts = [val.encode() for val in (title, text, answer or '')]
+            f.write(b''.join(parts))
+            key = make_pool_key(category, difficulty)
+            q_ids.append(q_id)
+            records.append(RECORD.pack(difficulty, category.encode(), offset,
+                                       len(parts[0]), len(parts[1]),
+                                       len(parts[2]) if answer is not None
+                                       else -1))
+            levels.setdefault(key, array('I')).append(q_id)
+            by_q_id[q_id] = key
+
+        subjects = {}
+        rows = (db.session.query(Subject.title, Q_Subj.q_id)
+                          .join(Q_Subj, Q_Subj.s_id == Subject.s_id)
+                          .order_by(Subject.title, Q_Subj.q_id))
+        for title, q_id in rows:
+            if q_id not in by_q_id:
+                continue
+            (subjects.setdefault(title.lower(), {})
+                     .setdefault(by_q_id[q_id], array('I')).append(q_id))
+
+        def write_ids(ids):
+            f.write(b'\0' * (-f.tell() % 4))  # align uint32 arrays
+            span = [f.tell(), len(ids)]
+            f.write(ids.tobytes())
+            return span
+
+        directory = {'count': len(q_ids), 'ids': write_ids(q_ids)}
+        directory['records'] = f.tell()
+        f.write(b''.join(records))
+        directory['levels'] = {key: write_ids(ids)
+                               for key, ids in levels.items()}
+        directory['subjects'] = {subject: {key: write_ids(ids)
+                                           for key, ids in pools.items()}
+                                 for subject, pools in subjects.items()}
+
+        dir_offset = f.tell()
+        dir_bytes = json.dumps(directory, sort_keys=True).encode()
+        f.write(dir_bytes)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, dir_offset, len(dir_bytes)))
+
+    os.replace(tmp_path, path)
+
+    return len(q_ids)
+
+
+def make_pool_key(category, difficulty):
+    """ Makes the directory key of a (category, difficulty) pool, eg 'C2'. """
+    return '{}{}'.format(category, difficulty)
@@ -3,9 +3,31 @@
 # Tests Model and CLIJ modules -- assumes Flask-SQLAlchemy and SQLAlchemy teams
 # have ensured their products work.
 
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
 import unittest as UT
+from contextlib import contextmanager
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
 from model import *
+from classes import *
 from clij import *
+from snapshot import *
+from calibrate import calibrate_arrays
+from instrument import QueryStats
+from migrations import get_version, upgrade, MIGRATIONS
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import classes
+import clij
+import model
+import server
+import numpy as np
 
 # create database and seed functions for clijtest
 def setUpModule():
@@ -15,8 +37,12 @@ def setUpModule():
     app = Flask(__name__)
     app.config['TESTING'] = True  # Shows verbose Flask error messages
 
-    # Connect to DB
-    connect_to_db(app)
+    # Connect to an in-memory SQLite DB; no server needed
+    connect_to_db(app, db_uri='memory')
+
+    db.session.add(User('default'))
+    db.session.add(Question('test 193736', 'test text', difficulty=1))
+    db.session.commit()
 
 
 def tearDownModule():
@@ -24,21 +50,255 @@ def tearDownModule():
     pass
 
 
-class ModelHelperFuncsTests(UT.TestCase):
+@contextmanager
+def file_db():
+    """ Points the model at a new SQLite file DB, which has a real connection
+        pool, for the block; then back at the in-memory test DB.
+
+    """
+
+    old_app = db.app
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db.session.remove()
+        question_bank.invalidate()
+        app = Flask(__name__)
+        connect_to_db(app, db_uri='sqlite:///' + os.path.join(tmp_dir,
+                                                              'test.sqlite3'))
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.get_engine(app).dispose()
+            db.app = old_app
+            question_bank.invalidate()
+
+
+def seed_game_questions(per_level=4):
+    """ Adds enough questions of each category and difficulty for games. """
+
+    rows = [{'title': 'test game {} {} {}'.format(category, level, i),
+             'text': 'text', 'difficulty': level, 'category': category,
+             'answer': 'answer'}
+            for category in 'BTC' for level in range(1, 4)
+            for i in range(per_level)]
+    Question.bulk_create(col='title', rows=rows)
+    question_bank.invalidate()
+
+
+def write_question_file(file_dir, name, lines, mtime=None):
+    """ Writes a question file of 'lines', optionally with a set mtime so
+        edits are seen however fast the test runs.
+
+    """
 
-    def test_make_qs_id(self):
-        """ Tests format and content of concatenated integer. """
+    path = os.path.join(file_dir, name)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    if mtime:
+        os.utime(path, (mtime, mtime))
 
-        self.assertEqual(make_qs_id(1, 1), 11)
-        self.assertEqual(make_qs_id(31, 217), 31217)
+    return path
 
 
+class ModelHelperFuncsTests(UT.TestCase):
+
     def test_make_score_id(self):
         """ Tests format and content of concatenated string. """
 
         self.assertEqual(make_score_id('username', 7), 'username--7')
 
 
+    def test_validate_engine_options(self):
+        """ Tests that bad pool settings fail at startup. """
+
+        self.assertIsNone(validate_engine_options({'pool_size': 10,
+                                                   'pool_pre_ping': True}))
+        with self.assertRaises(ValueError):
+            validate_engine_options({'pool_sise': 10})
+        with self.assertRaises(ValueError):
+            validate_engine_options({'max_overflow': -2})
+
+
+class ClassesHelperFuncsTests(UT.TestCase):
+
+    def test_choose_difficulty_counts(self):
+        """ Tests that counts meet the minimums and hit the total exactly. """
+
+        for i in range(50):
+            counts = choose_difficulty_counts((9, 2, 2, 0), (5, 5, 5))
+            self.assertEqual(sum(lvl * n for lvl, n in enumerate(counts, 1)), 9)
+            self.assertTrue(counts[0] >= 2 and counts[1] >= 2)
+
+        self.assertEqual(choose_difficulty_counts((6, 1, 1, 0), (1, 1, 1)),
+                         (1, 1, 1))
+
+
+    def test_choose_difficulty_counts_errors(self):
+        """ Tests fail-fast reasons for rules the bank can't satisfy. """
+
+        with self.assertRaises(QuestionRulesError):
+            choose_difficulty_counts((9, 2, 2, 0), (1, 5, 5))
+        with self.assertRaises(QuestionRulesError):
+            choose_difficulty_counts((3, 2, 2, 0), (5, 5, 5))
+        with self.assertRaises(QuestionRulesError):
+            choose_difficulty_counts((9, 1, 1, 0), (1, 1, 0))
+
+
+    def test_game_prefetcher(self):
+        """ Tests that games are built on the worker against a pooled file
+            DB, that a build error raised there comes out of 'take', and that
+            the worker gives its connection back.
+
+        """
+
+        with file_db():
+            session = Session()
+            session.user = 'default'
+            prefetcher = GamePrefetcher(session)
+
+            prefetcher.start(g_id=1)
+            self.assertIsInstance(prefetcher._next.exception(timeout=10),
+                                  QuestionRulesError)
+            with self.assertRaises(QuestionRulesError):
+                prefetcher.take(g_id=1)
+
+            seed_game_questions()
+            prefetcher.start(g_id=2)
+            game = prefetcher.take(g_id=2)
+            self.assertEqual(len(game._question_sets), 3)
+            self.assertEqual(db.engine.pool.checkedout(), 0)
+            prefetcher.close()
+
+
+class InstrumentTests(UT.TestCase):
+
+    def test_query_stats(self):
+        """ Tests statement, changed row and fetched row counts per tracked
+            operation, and the JSON export.
+
+        """
+
+        stats = QueryStats()
+        engine = create_engine('sqlite://')
+        engine.execute("CREATE TABLE t (n INTEGER)")  # before enabling
+
+        @stats.track('fill')
+        def fill():
+            engine.execute("INSERT INTO t (n) VALUES (?)", [(1,), (2,), (3,)])
+            return engine.execute("SELECT n FROM t").fetchall()
+
+        self.assertEqual(len(fill()), 3)  # disabled; not counted
+        self.assertEqual(stats.summary(), {})
+
+        stats.enable(engine)
+        fill()
+        with stats.operation('read'):
+            engine.execute("SELECT n FROM t WHERE n > 2").fetchall()
+            engine.execute("SELECT n FROM t").fetchone()
+
+        summary = stats.summary()
+        self.assertEqual({name: (op['calls'], op['statements'], op['rows'])
+                          for name, op in summary.items()},
+                         {'fill': (1, 2, 9), 'read': (1, 2, 3)})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'stats.json')
+            stats.export(path)
+            with open(path) as f:
+                self.assertEqual(json.load(f), summary)
+
+
+class MigrationTests(UT.TestCase):
+
+    def test_upgrade(self):
+        """ Tests that a new DB is stamped current and upgrades to nothing. """
+
+        self.assertEqual(get_version(), MIGRATIONS[-1][0])
+        self.assertEqual(upgrade(), 0)
+
+
+    def test_upgrade_baseline(self):
+        """ Tests that a DB from before versioning runs every step and keeps
+            its subject links, score histories and durations.
+
+        """
+
+        baseline = [
+            "CREATE TABLE subjects (s_id INTEGER PRIMARY KEY, "
+            "title TEXT NOT NULL UNIQUE)",
+            "CREATE TABLE questions (q_id INTEGER PRIMARY KEY, "
+            "title TEXT NOT NULL UNIQUE, text TEXT NOT NULL, "
+            "difficulty INTEGER NOT NULL, durations TEXT NOT NULL, "
+            "category VARCHAR(1) NOT NULL, answer TEXT)",
+            "CREATE TABLE qs_subjs (qs_id INTEGER PRIMARY KEY, "
+            "q_id INTEGER NOT NULL REFERENCES questions (q_id), "
+            "s_id INTEGER NOT NULL REFERENCES subjects (s_id))",
+            "CREATE TABLE users (u_id TEXT PRIMARY KEY)",
+            "CREATE TABLE scores (score_id TEXT PRIMARY KEY, "
+            "u_id TEXT NOT NULL REFERENCES users (u_id), "
+            "q_id INTEGER NOT NULL REFERENCES questions (q_id), "
+            "points TEXT NOT NULL)",
+            "INSERT INTO subjects VALUES (1, 'old subject')",
+            "INSERT INTO questions VALUES (1, 'old question', 'text', 2, "
+            "'120,60,', 'B', NULL)",
+            "INSERT INTO qs_subjs VALUES (11, 1, 1), (111, 1, 1)",
+            "INSERT INTO users VALUES ('veteran')",
+            "INSERT INTO scores VALUES ('veteran1', 'veteran', 1, '2,4,')",
+        ]
+
+        with file_db():
+            db.session.remove()
+            db.drop_all()
+            db.engine.execute("DROP TABLE IF EXISTS questions_fts")
+            for sql in baseline:
+                db.engine.execute(sql)
+
+            self.assertEqual(get_version(), 0)
+            self.assertEqual(upgrade(), len(MIGRATIONS))
+            self.assertEqual(get_version(), MIGRATIONS[-1][0])
+            self.assertEqual(upgrade(), 0)
+
+            self.assertNotIn('qs_id', [column['name'] for column in db.inspect(
+                db.engine).get_columns('qs_subjs')])
+            self.assertEqual(db.session.query(Q_Subj.q_id, Q_Subj.s_id).all(),
+                             [(1, 1)])
+            self.assertEqual(ScoreEvent.get_history('veteran', 1), [2, 4])
+            self.assertEqual(Question.query.get(1).durations, [120, 60])
+            self.assertEqual([question.title for question, rank
+                              in Question.search('old')], ['old question'])
+            stat = LeaderStat.query.get(make_leader_id('all', 'veteran'))
+            self.assertEqual((stat.count, stat.total, stat.best), (2, 6, 4))
+
+
+    def test_durations(self):
+        """ Tests integer durations and parsing of the old text format. """
+
+        question = Question.create('test durations', 'text')
+        db.session.expire(question)
+        self.assertEqual(question.durations, [180])
+        self.assertEqual(parse_int_list('120,60,'), [120, 60])
+        self.assertEqual(parse_int_list(''), [])
+
+
+class CalibrateTests(UT.TestCase):
+
+    def test_calibrate_arrays(self):
+        """ Tests difficulty suggestions relative to each user's own mean. """
+
+        u_codes = np.repeat(np.arange(4), 3)
+        q_ids = np.tile([10, 20, 30], 4)
+        points = np.tile([5, 1, 3], 4)
+
+        stats = calibrate_arrays(u_codes, q_ids, points, min_count=4)
+        self.assertEqual(stats['q_id'].tolist(), [10, 20, 30])
+        self.assertEqual(stats['relative'].tolist(), [3.0, -3.0, 0.0])
+        self.assertEqual(stats['suggested'].tolist(), [1, 3, 2])
+        self.assertTrue(np.isnan(stats['discrimination']).all())
+
+        stats = calibrate_arrays(u_codes, q_ids, points, min_count=5)
+        self.assertEqual(len(stats['q_id']), 0)
+
+
 class ModelBaseMethods(UT.TestCase):
 
     def test_get_records(self):
@@ -61,10 +321,438 @@ class ModelQuestionMethods(UT.TestCase):
 
         """
 
-        pass
+        question = Question.create('test create', 'some text', difficulty=3)
+        self.assertIsNotNone(question.q_id)
+        self.assertEqual(Question.get_records(col='title', val='test create'),
+                         [question])
+        self.assertIsNone(Question.create('test create', 'other text'))
+
+        self.assertIsNone(User.create('default'))
+
+
+    def test_create_errors(self):
+        """ Tests that only key conflicts are skipped; bad rows raise. """
+
+        question = Question.create('test create errors', 'text')
+        subject = Subject.create('test create errors')
+        link = {'q_id': question.q_id, 's_id': subject.s_id}
+        self.assertEqual(Q_Subj.link([link, link]), (1, 1))
+
+        with self.assertRaises(IntegrityError):
+            Question.create('test no text', None)
+        db.session.rollback()
+        with self.assertRaises(IntegrityError):
+            Q_Subj.link([{'q_id': question.q_id, 's_id': 10 ** 6}])
+        db.session.rollback()
+
+
+    def test_search(self):
+        """ Tests ranked full-text matches kept in step with inserts. """
+
+        question = Question.create('test searching trees', 'Balance a tree.',
+                                   answer='Rotate it.', category='C')
+        matches = Question.search('tree balancing')
+        self.assertEqual([match for match, rank in matches], [question])
+        self.assertEqual(Question.search('rotate', category='B'), [])
+        self.assertEqual(Question.search('  '), [])
+
+
+    def test_subject_filter(self):
+        """ Tests bank lookups by any or all of several subjects. """
+
+        Subject.create('test subj one')
+        Subject.create('test subj two')
+        both = Question.create('test subjects both', 'text', category='B')
+        one = Question.create('test subjects one', 'text', category='B')
+        both.add_subjects(['test subj one', 'test subj two'])
+        one.add_subjects(['test subj one', 'test subj one'])
+
+        pairs = question_bank.get('B', 2, subjects=['Test Subj One'])
+        self.assertEqual(sorted(pairs), [(both.q_id, 2), (one.q_id, 2)])
+        pairs = question_bank.get('B', 2, subjects=['test subj one',
+                                                    'test subj two'],
+                                  match_all=True)
+        self.assertEqual(pairs, [(both.q_id, 2)])
+        self.assertEqual(question_bank.get('T', 2, subjects=['test subj two']),
+                         [])
+
+
+class SeedTests(UT.TestCase):
+
+    def test_parse_question_files(self):
+        """ Tests parsed fields, multi-line text and answers, and digests,
+            in a pool of parser processes.
+
+        """
+
+        attr_keys = [key.upper() for key in Question.__table__.columns.keys()]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [write_question_file(tmp_dir, 'q{}.txt'.format(i),
+                                         ['', 'TITLE: test parse {}'.format(i),
+                                          'DIFFICULTY: 1',
+                                          'DURATIONS: 60, 120',
+                                          'SUBJECTS: Graph, Tree',
+                                          'TEXT: first line', 'second line',
+                                          'ANSWER: answer', 'NOTE: continued'])
+                     for i in range(6)]
+
+            records = sorted(parse_question_files(paths, attr_keys,
+                                                  processes=2))
+            self.assertEqual(len(records), 6)
+            title, text, attrs, subjs = records[0]
+            self.assertEqual((title, text, subjs),
+                             ('test parse 0', 'first line\nsecond line',
+                              ['Graph', 'Tree']))
+            self.assertEqual((attrs['difficulty'], attrs['durations'],
+                              attrs['answer']),
+                             ('1', '60, 120', 'answer\nNOTE: continued'))
+
+            digests = dict((path, digest) for path, digest, record
+                           in parse_question_files(paths, attr_keys,
+                                                   processes=2, digest=True))
+            with open(paths[0], 'rb') as f:
+                self.assertEqual(digests[paths[0]],
+                                 hashlib.sha256(f.read()).hexdigest())
+
+
+    def test_bulk_seed(self):
+        """ Tests inserted and skipped counts of bulk seeding in batches. """
+
+        with file_db(), tempfile.TemporaryDirectory() as tmp_dir:
+            rows = [{'title': 'test bulk row {}'.format(i)} for i in range(5)]
+            self.assertEqual(Subject.bulk_create(col='title',
+                                                 rows=rows + [{'title': ''}],
+                                                 batch_size=2),
+                             (5, 1))
+            self.assertEqual(Subject.bulk_create(col='title', rows=rows),
+                             (0, 5))
+
+            inserted, skipped = seed_subjects(bulk=True)
+            self.assertEqual(seed_subjects(bulk=True),
+                             (0, inserted + skipped))
+
+            write_question_file(tmp_dir, 'one.txt',
+                                ['TITLE: test bulk one', 'TEXT: text one'])
+            write_question_file(tmp_dir, 'copy.txt',
+                                ['TITLE: test bulk one', 'TEXT: copied'])
+            write_question_file(tmp_dir, 'two.txt',
+                                ['TITLE: test bulk two', 'TEXT: text two',
+                                 'DIFFICULTY: 3', 'CATEGORY: C',
+                                 'SUBJECTS: test bulk row 1, test bulk nope'])
+
+            counts = seed_questions_qsubjs(bulk=True, processes=1,
+                                           file_dir=tmp_dir)
+            self.assertEqual((counts['questions'], counts['qs_subjs']),
+                             ((2, 1), (1, 0)))
+
+            question = Question.query.filter_by(title='test bulk two').one()
+            self.assertEqual((question.difficulty, question.category,
+                              [subject.title
+                               for subject in question.subjects]),
+                             (3, 'C', ['test bulk row 1']))
+
+            question = Question.query.filter_by(title='test bulk one').one()
+            self.assertEqual(SeedFile.query.filter_by(q_id=question.q_id)
+                                           .count(), 1)  # copy not aliased
+
+
+    def test_reseed(self):
+        """ Tests that a re-seed skips unchanged files, updates edited ones,
+            skips invalid edits and copies, adopts renamed files and retires
+            deleted files only if asked.
+
+        """
+
+        def seed(**kwargs):
+            return seed_questions_qsubjs(processes=1, file_dir=tmp_dir,
+                                         **kwargs)
+
+        def get_text(title):
+            question = Question.query.filter_by(title=title).first()
+            return question.text if question else None
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in 'abc':
+                write_question_file(tmp_dir, name + '.txt',
+                                    ['TITLE: test seed ' + name,
+                                     'TEXT: text ' + name], mtime=1000)
+
+            counts = seed()
+            self.assertEqual(counts['questions'], (3, 0))
+            self.assertEqual(seed()['unchanged'], 0)  # not even opened
+
+            write_question_file(tmp_dir, 'a.txt', ['TITLE: test seed a',
+                                                   'TEXT: text a'], mtime=2000)
+            write_question_file(tmp_dir, 'b.txt', ['TITLE: test seed b',
+                                                   'TEXT: new text b'],
+                                mtime=2000)
+            counts = seed()
+            self.assertEqual((counts['unchanged'], counts['updated']), (1, 1))
+            self.assertEqual(get_text('test seed b'), 'new text b')
+
+            for mtime, lines in [(3000, ['TEXT: no title']),
+                                 (4000, ['TITLE: test seed a',
+                                         'TEXT: title taken'])]:
+                write_question_file(tmp_dir, 'c.txt', lines, mtime=mtime)
+                counts = seed()
+                self.assertEqual((counts['questions'], counts['updated']),
+                                 ((0, 1), 0))
+                self.assertEqual(get_text('test seed c'), 'text c')
+                self.assertEqual(get_text('test seed a'), 'text a')
+
+            write_question_file(tmp_dir, 'd.txt', ['TITLE: test seed b',
+                                                   'TEXT: copied b'])
+            self.assertEqual(seed()['questions'], (0, 2))  # c.txt, d.txt
+            self.assertEqual(get_text('test seed b'), 'new text b')
+            os.remove(os.path.join(tmp_dir, 'd.txt'))
+
+            os.rename(os.path.join(tmp_dir, 'b.txt'),
+                      os.path.join(tmp_dir, 'e.txt'))
+            self.assertEqual(seed()['updated'], 1)  # adopted from b.txt
+
+            os.remove(os.path.join(tmp_dir, 'a.txt'))
+            self.assertEqual(seed()['retired'], 0)
+            self.assertEqual(get_text('test seed a'), 'text a')
+            self.assertEqual(seed(retire=True)['retired'], 1)
+            self.assertIsNone(get_text('test seed a'))
+            self.assertEqual(get_text('test seed b'), 'new text b')
+
+
+class ModelScoreMethods(UT.TestCase):
+
+    def test_migrate_score_points(self):
+        """ Tests that old 'points' strings become events and stats once. """
+
+        User.create('migrator')
+        question = Question.create('test migrate', 'text', category='B')
+        score = Score.create('migrator', question.q_id)
+        score.points = '2,4,'
+        db.session.commit()
+
+        self.assertEqual(migrate_score_points(), 2)
+        self.assertEqual(migrate_score_points(), 0)
+        self.assertEqual(ScoreEvent.get_history('migrator', question.q_id),
+                         [2, 4])
+        self.assertEqual(Score.query.get(score.score_id).points, '')
+
+        stat = ScoreStat.get(u_id='migrator', q_id=question.q_id)
+        self.assertEqual((stat.count, stat.total, stat.last), (2, 6, 4))
+        self.assertAlmostEqual(stat.rolling, 2 + STAT_ALPHA * 2)
+        for stat in (ScoreStat.get(u_id='migrator'),
+                     ScoreStat.get(q_id=question.q_id)):
+            self.assertEqual((stat.count, stat.total), (2, 6))
+
+
+    def test_get_priorities(self):
+        """ Tests that the most overdue questions come first: low scores are
+            due sooner, and unscored questions count as just due.
+
+        """
+
+        with file_db():
+            User.create('reviewer')
+            q_ids = [Question.create('test review {}'.format(i), 'text').q_id
+                     for i in range(4)]
+            now = datetime.datetime(2018, 5, 1)
+            day = datetime.timedelta(days=1)
+            ScoreStat.record([{'u_id': 'reviewer', 'q_id': q_id,
+                               'points': points,
+                               'created_at': now - days * day}
+                              for q_id, points, days in [(q_ids[0], 5, 2),
+                                                         (q_ids[1], 1, 2),
+                                                         (q_ids[2], 3, 1)]])
+            db.session.commit()
+
+            priorities = ScoreStat.get_priorities('reviewer', now=now)
+            self.assertEqual(priorities, {q_ids[0]: 2 / 16, q_ids[1]: 2 / 1,
+                                          q_ids[2]: 1 / 4})
+
+            q_set = QuestionSet.__new__(QuestionSet)
+            q_set._priorities = priorities
+            pool = [(q_id, 2) for q_id in q_ids]
+            self.assertEqual(q_set._get_most_due(pool, 3),
+                             [(q_ids[1], 2), (q_ids[3], 2), (q_ids[2], 2)])
+
+
+class ModelLeaderStatMethods(UT.TestCase):
+
+    def test_get_leaders(self):
+        """ Tests that boards follow score writes and match a rebuild. """
+
+        User.create('leader')
+        question = Question.create('test leaders', 'text', category='C')
+        scores = ScoreBuffer(say=lambda msg: None)
+        for points in (2, 5):
+            scores.add(u_id='leader', q_id=question.q_id, new_points=points)
+        scores.flush()
+
+        (leader,) = LeaderStat.get_leaders(category='C')
+        self.assertEqual((leader.u_id, leader.mean, leader.best), ('leader',
+                                                                   3.5, 5))
+        self.assertEqual(LeaderStat.get_leaders(category='C', min_count=3),
+                         [])
+        with self.assertRaises(ValueError):
+            LeaderStat.get_leaders(by='worst')
+
+        def get_boards():
+            stats = (LeaderStat.query.filter_by(u_id='leader')
+                                     .order_by(LeaderStat.leader_id))
+            return [(stat.leader_id, stat.count, stat.mean, stat.best)
+                    for stat in stats]
+
+        before = get_boards()
+        rebuild_leaderboard()
+        db.session.expire_all()
+        self.assertEqual(before, get_boards())
+
+
+    def test_concurrent_flushes(self):
+        """ Tests that flushes from two sessions at once both count. """
+
+        with file_db():
+            User.create('racer')
+            question = Question.create('test racing', 'text', category='T')
+            barrier = threading.Barrier(2)
+
+            def flush(points):
+                scores = ScoreBuffer(say=lambda msg: None)
+                for val in points:
+                    scores.add(u_id='racer', q_id=question.q_id,
+                               new_points=val)
+                barrier.wait()
+                scores.flush()
+                db.session.remove()
+
+            threads = [threading.Thread(target=flush, args=(points,))
+                       for points in ([1, 2], [4, 5, 3])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for board in ('all', 'c:T'):
+                stat = LeaderStat.query.get(make_leader_id(board, 'racer'))
+                self.assertEqual((stat.count, stat.total, stat.mean,
+                                  stat.best), (5, 15, 3.0, 5))
+            stat = ScoreStat.get(u_id='racer', q_id=question.q_id)
+            self.assertEqual((stat.count, stat.total), (5, 15))
+
+
+class ServerTests(UT.TestCase):
+
+    def test_load_backend(self):
+        """ Tests that connecting to an existing DB at startup gives the
+            connection back.
+
+        """
+
+        old_app = db.app
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_uri = 'sqlite:///' + os.path.join(tmp_dir, 'test.sqlite3')
+            try:
+                for _ in range(2):  # create, then reopen
+                    db.session.remove()
+                    clij.load_backend(db_uri=db_uri)
+                    self.assertEqual(db.engine.pool.checkedout(), 0)
+            finally:
+                db.session.remove()
+                db.engine.dispose()
+                db.app = old_app
+                question_bank.invalidate()
+
+
+    def test_scripted_game(self):
+        """ Tests a scripted player through a game over a local socket, and
+            that a player over the cap is turned away.
+
+        """
+
+        replies = [("User ID", 'player'), ("to skip", 'y'),
+                   ("when you're done", 'ok'), ("points 1 to 5", '4'),
+                   ("'y' to continue", 'n')]  # first match wins
+
+        async def play(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            output = ''
+            answered = 0
+            try:
+                while True:
+                    chunk = (await reader.read(4096)).decode()
+                    if not chunk:
+                        break
+                    output += chunk
+                    if not output.endswith("quit) "):
+                        continue
+                    prompt = output[output.rindex("(enter "):]
+                    reply = next(reply for hint, reply in replies
+                                 if hint in prompt)
+                    answered += reply == '4'
+                    if reply == 'n':
+                        # This player holds the only seat
+                        self.assertIn("seats", await turned_away(port))
+                    writer.write((reply + '\n').encode())
+            finally:
+                writer.close()  # a failed script hangs up, ending the session
+            return output, answered
+
+        async def turned_away(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            output = (await reader.read()).decode()
+            writer.close()
+            return output
+
+        async def run():
+            executor = ThreadPoolExecutor(max_workers=2)
+            seats = server.Seats(1)
+            tcp = await asyncio.start_server(
+                lambda reader, writer: server.handle_connection(
+                    reader, writer, executor, seats),
+                '127.0.0.1', 0)
+            try:
+                return await asyncio.wait_for(
+                    play(tcp.sockets[0].getsockname()[1]), 30)
+            finally:
+                tcp.close()
+                executor.shutdown(wait=False)
+
+        clij.model, clij.classes = model, classes
+        with file_db():
+            seed_game_questions()
+            output, answered = asyncio.run(run())
+
+            self.assertIn("New User 'player' created!", output)
+            self.assertIn("Goodbye!", output)
+            self.assertNotIn("Sorry", output)
+            self.assertGreater(answered, 0)
+            self.assertEqual(ScoreEvent.query.filter_by(u_id='player').count(),
+                             answered)
+            self.assertEqual(ScoreStat.get(u_id='player').count, answered)
+
+
+class SnapshotTests(UT.TestCase):
+
+    def test_export_and_load(self):
+        """ Tests that a snapshot serves the same pools and questions as the
+            DB-backed bank.
+
+        """
 
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'bank.snap')
+            self.assertEqual(export_snapshot(path), Question.query.count())
+            bank = SnapshotBank(path)
 
+            for category in 'BTC':
+                for level in range(1, 4):
+                    self.assertEqual(
+                        sorted(bank.get(category, level)),
+                        sorted(question_bank.get(category, level)))
 
+            question = Question.query.first()
+            (loaded,) = bank.hydrate([question.q_id, 10 ** 6])
+            self.assertEqual((loaded.title, loaded.text, loaded.answer),
+                             (question.title, question.text, question.answer))
+            del bank, loaded  # release the mapping before the file goes
 
 
 if __name__ == '__main__':